@@ -6,6 +6,9 @@ setup(
       name='Uni Wiki Ships',
       version='0.1.0',
       packages=['uni_wiki_ships'],
+      extras_require={
+        'numpy': ['numpy'],
+      },
       entry_points={
         'console_scripts': [
             'wikiships = uni_wiki_ships.main:main',
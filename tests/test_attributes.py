@@ -0,0 +1,28 @@
+from uni_wiki_ships import attributes
+import unittest
+
+def _hash(function):
+    attr = attributes.Attribute('cpuOutput', 'cpu', ' tf', function)
+    attributes.attributes.remove(attr)
+    return attributes.config_hash([attr])
+
+def _scaled(scale):
+    return lambda x: x * scale
+
+class ConfigHashTest(unittest.TestCase):
+    def test_same_function(self):
+        self.assertEqual(_hash(lambda x: round(x, 3)), _hash(lambda x: round(x, 3)))
+
+    def test_names_used(self):
+        self.assertNotEqual(_hash(lambda x: round(x, 3)), _hash(lambda x: max(x, 3)))
+
+    def test_closures(self):
+        self.assertEqual(_hash(_scaled(2)), _hash(_scaled(2)))
+        self.assertNotEqual(_hash(_scaled(2)), _hash(_scaled(3)))
+
+    def test_nested_code(self):
+        self.assertNotEqual(_hash(lambda x: (lambda y: y + 1)(x)),
+                            _hash(lambda x: (lambda y: y + 2)(x)))
+
+if __name__ == '__main__':
+    unittest.main()
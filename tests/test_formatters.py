@@ -0,0 +1,66 @@
+from decimal import Decimal
+from uni_wiki_ships import formatters
+import json
+import unittest
+
+PAGES = {
+    u'Rifter': u'intro\n{{ShipBox\n|cpu=100\n|mass=1,000}}',
+    u'Slasher': u'{{ShipBox\n|cpu=100\n|mass=1,000}}\n',
+}
+SHIPS = {
+    u'Rifter': {'cpu': Decimal(125), 'mass': Decimal(1250)},
+    u'Slasher': {'cpu': Decimal(100), 'mass': Decimal(1250)},
+}
+
+def _output(formatter):
+    return ''.join(formatter.stream([(PAGES, [])], SHIPS))
+
+class PatchTest(unittest.TestCase):
+    def test_diff(self):
+        self.assertEqual(_output(formatters.Patch()), ''.join([
+            '--- a/Rifter.wiki\n',
+            '+++ b/Rifter.wiki\n',
+            '@@ -3,2 +3,2 @@\n',
+            '-|cpu=100\n',
+            '-|mass=1,000}}\n',
+            '\\ No newline at end of file\n',
+            '+|cpu=125\n',
+            '+|mass=1,250}}\n',
+            '\\ No newline at end of file\n',
+            '--- a/Slasher.wiki\n',
+            '+++ b/Slasher.wiki\n',
+            '@@ -3 +3 @@\n',
+            '-|mass=1,000}}\n',
+            '+|mass=1,250}}\n',
+        ]))
+
+    def test_names(self):
+        formatter = formatters.Patch()
+        formatter.pages = {u'Tristan Navy': u'{{ShipBox|cpu=1}}\n'}
+        formatter.infoboxes = {u'Tristan Navy': formatters.infobox.parse(
+                formatter.pages[u'Tristan Navy'])}
+        wrong = formatters.compare.compare(formatter.infoboxes,
+                                           {u'Tristan Navy': {'cpu': Decimal(2)}})
+        self.assertTrue(formatter.format_wrong(wrong).startswith(
+                '--- a/Tristan_Navy.wiki\n+++ b/Tristan_Navy.wiki\n'))
+
+class EditsTest(unittest.TestCase):
+    def test_edits(self):
+        edits = json.loads(_output(formatters.Edits()))
+        self.assertEqual(edits, [
+            {'page': 'Rifter', 'attribute': 'cpu', 'line': 3, 'start': 21,
+             'end': 24, 'old': '100', 'new': '125'},
+            {'page': 'Rifter', 'attribute': 'mass', 'line': 4, 'start': 31,
+             'end': 36, 'old': '1,000', 'new': '1,250'},
+            {'page': 'Slasher', 'attribute': 'mass', 'line': 3, 'start': 25,
+             'end': 30, 'old': '1,000', 'new': '1,250'},
+        ])
+        for edit in edits:
+            self.assertEqual(PAGES[edit['page']][edit['start']:edit['end']], edit['old'])
+
+    def test_nothing_wrong(self):
+        formatter = formatters.Edits()
+        self.assertEqual(''.join(formatter.stream([({}, [])], SHIPS)), '[]\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+from uni_wiki_ships import infobox
+import unittest
+
+class ParseTest(unittest.TestCase):
+    def test_fields(self):
+        page = u'intro\n{{ShipBox\n|cpu = 100 tf\n|mass=1,000}}\ntext'
+        fields = infobox.parse(page)
+        self.assertEqual(sorted(fields), ['cpu', 'mass'])
+        self.assertEqual(fields['cpu'].value, '100 tf')
+        self.assertEqual(page[fields['mass'].start:fields['mass'].end], '1,000')
+
+    def test_other_templates_ignored(self):
+        fields = infobox.parse(u'{{Other|mass=5}}\n{{ShipBox|cpu=100}}')
+        self.assertEqual(sorted(fields), ['cpu'])
+
+    def test_template_name(self):
+        for name in ('ShipBox', 'shipBox', 'ShipBox_Frigate', 'ShipBox Frigate'):
+            self.assertIn('cpu', infobox.parse(u'{{%s|cpu=1}}' % name), name)
+
+    def test_nested_values(self):
+        fields = infobox.parse(u'{{ShipBox|role=[[Tackle|tackle]] {{Tip|a=b}}|cpu=1}}')
+        self.assertEqual(fields['role'].value, '[[Tackle|tackle]] {{Tip|a=b}}')
+        self.assertNotIn('a', fields)
+        self.assertEqual(fields['cpu'].value, '1')
+
+    def test_first_value_used(self):
+        fields = infobox.parse(u'{{ShipBox|cpu=1|cpu=2}}')
+        self.assertEqual(fields['cpu'].value, '1')
+
+class RewriteTest(unittest.TestCase):
+    def test_numbers_replaced(self):
+        page = u'{{ShipBox\n|cpu= 100 tf\n|mass=1,000 kg\n|name=Rifter}}'
+        fields = infobox.parse(page)
+        self.assertEqual(infobox.rewrite(page, fields, {'cpu': '125', 'mass': '1,250'}),
+                         u'{{ShipBox\n|cpu= 125 tf\n|mass=1,250 kg\n|name=Rifter}}')
+
+    def test_other_fields_left_alone(self):
+        page = u'{{Other|mass=5}}{{ShipBox|name=Rifter|cpu=}}'
+        fields = infobox.parse(page)
+        values = {'mass': '6', 'name': '1', 'cpu': '2'}
+        self.assertEqual(infobox.rewrite(page, fields, values), page)
+
+if __name__ == '__main__':
+    unittest.main()
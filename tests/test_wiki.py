@@ -0,0 +1,80 @@
+from uni_wiki_ships import fakewiki, wiki
+import unittest
+
+PAGES = dict((u'Ship {}'.format(i), u'{{ShipBox|cpu=%s}}' % i) for i in range(120))
+
+class _BadTitleWiki(fakewiki.FakeWiki):
+    """Answers without the revisions of BAD, as for a page the API cannot read"""
+    BAD = u'Ship 42'
+
+    def _action_query(self, params):
+        response = fakewiki.FakeWiki._action_query(self, params)
+        for page in response.get('query', {}).get('pages', {}).values():
+            if page.get('title') == self.BAD:
+                page.pop('revisions', None)
+        return response
+
+class _ErrorWiki(fakewiki.FakeWiki):
+    """Answers every query with an API error, as when rate limited"""
+
+    def _action_query(self, params):
+        return fakewiki._error('ratelimited', 'You have exceeded your rate limit')
+
+class QueryPagesTest(unittest.TestCase):
+    def setUp(self):
+        self._backoff = wiki.BACKOFF
+        wiki.BACKOFF = 0.01
+        self.fake = None
+
+    def tearDown(self):
+        wiki.BACKOFF = self._backoff
+        if self.fake is not None:
+            self.fake.stop()
+
+    def _fetch(self, fake_wiki, titles=sorted(PAGES), concurrency=2):
+        self.fake = fake_wiki
+        fake_wiki.start()
+        client = wiki.Wiki(fake_wiki.url, rate=0, concurrency=concurrency)
+        return client, client.get_pages(titles)
+
+    def test_all_fetched(self):
+        client, (pages, missing) = self._fetch(fakewiki.FakeWiki(PAGES),
+                                               sorted(PAGES) + [u'No such ship'])
+        self.assertEqual(pages, PAGES)
+        self.assertEqual(missing, [u'No such ship'])
+        self.assertEqual(client.failed, [])
+        self.assertEqual(self.fake.stats['action.query'], 3)
+
+    def test_bad_title_isolated(self):
+        client, (pages, missing) = self._fetch(_BadTitleWiki(PAGES))
+        expected = dict(PAGES)
+        del expected[_BadTitleWiki.BAD]
+        self.assertEqual(pages, expected)
+        self.assertEqual(client.failed, [_BadTitleWiki.BAD])
+        #split down to the one title in its batch of 50, then retried alone
+        self.assertLessEqual(self.fake.stats['action.query'],
+                             3 + 2 * 6 + wiki.RETRIES)
+
+    def test_api_errors_not_split(self):
+        client, (pages, missing) = self._fetch(_ErrorWiki(PAGES))
+        self.assertEqual(pages, {})
+        self.assertEqual(sorted(client.failed), sorted(PAGES))
+        self.assertLessEqual(self.fake.stats['action.query'], 3 * (wiki.RETRIES + 1))
+
+    def test_server_errors_not_split(self):
+        client, (pages, missing) = self._fetch(fakewiki.FakeWiki(PAGES, error_rate=1))
+        self.assertEqual(pages, {})
+        self.assertEqual(sorted(client.failed), sorted(PAGES))
+        self.assertLessEqual(self.fake.stats['action.query'], 3 * (wiki.RETRIES + 1))
+
+    def test_some_server_errors_retried(self):
+        #one at a time so the seeded faults are the same every run
+        client, (pages, missing) = self._fetch(
+                fakewiki.FakeWiki(PAGES, error_rate=0.3, seed=1), concurrency=1)
+        self.assertEqual(pages, PAGES)
+        self.assertEqual(client.failed, [])
+        self.assertEqual(self.fake.summary()['title_failures'],
+                         self.fake.summary()['title_retries'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 from common import AppException
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import hashlib
+import infobox
 import logging
-import re
+import types
 logger = logging.getLogger(__name__)
 
 class NotPresentError(AppException): pass
@@ -27,12 +29,6 @@ class Attribute(object):
         """
         self.function = function
         self.name = wiki_name
-        self.regex = re.compile(r'''
-            \|         #section starts with |
-            {}         #followed by the wiki name
-            =          #then an equals
-            ([\d,\.]+) #allow numbers, thousand seperator and decimal points'''\
-            .format(self.name), re.X)
         self.db_name = db_name
         if not unit or unit.startswith(' '):
             self.unit = unit
@@ -62,11 +58,11 @@ class Attribute(object):
             raise NotPresentError('No value given for %s', self)
         return Decimal(self.function(Decimal(str(value))))
     
-    def extract(self, page):
+    def extract(self, fields):
         """Extract the value from a wiki page for this attribute
         
         Args:
-            page (str): a wiki page
+            fields (dict): the page's infobox as returned by infobox.parse
         Returns:
             (decimal): the value on the page
         Throws:
@@ -75,9 +71,9 @@ class Attribute(object):
         """
         try: 
             return Decimal(
-                    self.regex.search(page)\
-                    .expand(r'\1').replace(',', ''))
-        except AttributeError:
+                    infobox.NUMBER.match(fields[self.name].value)\
+                    .group(1).replace(',', ''))
+        except (KeyError, AttributeError, InvalidOperation):
             raise NotPresentError('No value for ' + str(self))  
     
 class SensorStrength(Attribute):
@@ -125,4 +121,58 @@ CONFIG = (
 )
 attributes = []
 for i in CONFIG:
-    Attribute(*i)
\ No newline at end of file
+    Attribute(*i)
+
+def expected_values(ships, attrs=None):
+    """Process the db values for ships into the values expected on the wiki
+    
+    Args:
+        ships (dict): {ship_name: {db_name: value}}
+        attrs (list): attributes to process, defaults to attributes
+    Returns:
+        (dict): {ship_name: {wiki_name: value}} without attributes a ship
+                    has no value for
+    
+    """
+    expected = {}
+    for ship, values in ships.iteritems():
+        expected[ship] = {}
+        for attr in attrs or attributes:
+            try:
+                expected[ship][attr.name] = attr.process(values)
+            except NotPresentError:
+                logger.debug('Ship %s has no value in db for %s', ship, attr)
+    return expected
+
+def config_hash(attrs=None):
+    """Hash of the attribute definitions, changes whenever expected values would
+    
+    The functions of the attributes are hashed by their code, including the
+    names they use, any nested code, default arguments and the values they
+    close over. Changes to the Attribute classes themselves are not seen, bump
+    cache.VERSION when making one.
+    
+    """
+    digest = hashlib.sha1()
+    for attr in attrs or attributes:
+        digest.update(repr((type(attr).__name__, attr.db_name, attr.name, attr.unit,
+                            _function_key(attr.function))))
+    return digest.hexdigest()
+
+def _function_key(function):
+    """Value which changes whenever what function does might"""
+    code = getattr(function, '__code__', None)
+    if code is None:
+        #builtins and other callables without code of their own
+        return repr(function)
+    closure = [_value_key(i.cell_contents) for i in function.__closure__ or ()]
+    defaults = [_value_key(i) for i in function.__defaults__ or ()]
+    return _code_key(code), closure, defaults
+
+def _code_key(code):
+    consts = [_code_key(i) if isinstance(i, types.CodeType) else i
+              for i in code.co_consts]
+    return code.co_code, consts, code.co_names
+
+def _value_key(value):
+    return _function_key(value) if callable(value) else repr(value)
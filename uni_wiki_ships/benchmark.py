@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Benchmark the hot paths of wikiships on synthetic data
+
+Usage:
+    python -m uni_wiki_ships.benchmark [options]
+
+Generates a static dump and ship pages of several sizes and times get_ships,
+infobox parsing, Attribute.extract, _Formatter.check and the format of each
+formatter. The data is made once for each size, then every benchmark runs in
+its own process which loads only the data it uses, so its peak memory can be
+reported. The results are written as JSON to compare across commits.
+
+"""
+
+from argparse import ArgumentParser
+from os import path
+import attributes
+import cPickle as pickle
+import collections
+import compare
+import formatters
+import infobox
+import json
+import main
+import multiprocessing
+import platform
+import profiling
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = (100, 1000, 5000)
+"""Default numbers of ships to benchmark with"""
+
+SHIP_GROUP = 25
+"""Group in the ship category used for the synthetic ships"""
+
+OTHER_GROUP = 18
+"""Group outside the ship category used for the other types"""
+
+def make_sde(name, ships, extra_attributes=100, seed=0):
+    """Create a synthetic static dump
+
+    The dump has the tables and columns get_ships uses, with ships published
+    ships, as many unpublished or non-ship types, and every type given a value
+    for each attribute in attributes.CONFIG along with extra_attributes others.
+
+    Args:
+        name (str): path to create the database at
+        ships (int): number of ships
+        extra_attributes (int): number of attributes not used by wikiships
+        seed (int): seed for the random values
+
+    """
+    rand = random.Random(seed)
+    names = [i.db_name for i in attributes.attributes]
+    names.extend('unusedAttribute{}'.format(i) for i in range(extra_attributes))
+    db_conn = sqlite3.connect(name)
+    try:
+        db_conn.executescript(
+            'CREATE TABLE invGroups (groupID INTEGER PRIMARY KEY, categoryID INTEGER);'
+            'CREATE TABLE invTypes (typeID INTEGER PRIMARY KEY, groupID INTEGER, '
+            'typeName TEXT, mass REAL, capacity REAL, volume REAL, published INTEGER);'
+            'CREATE TABLE dgmAttributeTypes (attributeID INTEGER PRIMARY KEY, '
+            'attributeName TEXT);'
+            'CREATE TABLE dgmTypeAttributes (typeID INTEGER, attributeID INTEGER, '
+            'valueInt INTEGER, valueFloat REAL, PRIMARY KEY (typeID, attributeID));')
+        db_conn.executemany('INSERT INTO invGroups VALUES (?, ?)',
+                            [(SHIP_GROUP, 6), (OTHER_GROUP, 4)])
+        db_conn.executemany('INSERT INTO dgmAttributeTypes VALUES (?, ?)',
+                            enumerate(names, 1))
+        for type_id in range(1, ships * 2 + 1):
+            is_ship = type_id <= ships
+            db_conn.execute('INSERT INTO invTypes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (type_id, SHIP_GROUP if is_ship or type_id % 2 else OTHER_GROUP,
+                     ship_name(type_id), rand.uniform(1e6, 1e9),
+                     rand.uniform(100, 10000), rand.uniform(1e4, 1e7),
+                     int(is_ship)))
+            db_conn.executemany('INSERT INTO dgmTypeAttributes VALUES (?, ?, ?, ?)',
+                    [_attribute_value(rand, type_id, attribute_id, attribute)
+                     for attribute_id, attribute in enumerate(names, 1)])
+        db_conn.commit()
+    finally:
+        db_conn.close()
+
+def _attribute_value(rand, type_id, attribute_id, name):
+    if name.endswith('Resonance'):
+        return type_id, attribute_id, None, round(rand.uniform(0.2, 1), 3)
+    if name.endswith('Slots') or name.endswith('Left') or name == 'maxLockedTargets':
+        return type_id, attribute_id, rand.randint(0, 8), None
+    return type_id, attribute_id, None, round(rand.uniform(1, 100000), 2)
+
+def ship_name(type_id):
+    return 'Ship {}'.format(type_id)
+
+def make_pages(expected, wrong_rate=0.1, missing_rate=0.05, seed=0):
+    """Create ship pages in the style of the wiki
+
+    Each page has an infobox with the expected values, some of them wrong or
+    missing, surrounded by text, links and other templates.
+
+    Args:
+        expected (dict): {ship_name: {wiki_name: value}}
+        wrong_rate (float): chance of each value being wrong
+        missing_rate (float): chance of each value being left out
+        seed (int): seed for the random choices
+    Returns:
+        (dict): {ship_name: page_content}
+
+    """
+    rand = random.Random(seed)
+    pages = {}
+    for ship, values in expected.iteritems():
+        fields = ['{{ShipBoxPrimary', '|name=' + ship, '|image=[[File:' + ship + '.png|200px]]']
+        for attr in attributes.attributes:
+            roll = rand.random()
+            if attr.name not in values or roll < missing_rate:
+                continue
+            value = values[attr.name]
+            if roll < missing_rate + wrong_rate:
+                value += rand.choice((-5, 5, 100))
+            fields.append('|{}={:,}{}'.format(attr.name, value, attr.unit))
+        fields.append('}}')
+        pages[ship] = (
+            '{{Stub}}\n'
+            "The '''" + ship + "''' is a [[Ship|ship]] used for benchmarking.\n"
+            + '\n'.join(fields) + '\n'
+            + '== Overview ==\n' + 'Lorem ipsum dolor sit amet. ' * 40 + '\n'
+            + '== Fitting ==\n{{Fitting|high=[[Gun]]|mid=[[Shield]]}}\n'
+            + '[[Category:Ship Database]]\n')
+    return pages
+
+class Data(object):
+    """Synthetic data for a size, saved in a directory"""
+
+    PARTS = ('expected', 'pages', 'infoboxes', 'wrong')
+    """Data saved alongside the dump, loaded with load"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.db = path.join(directory, 'eve.db')
+
+    @classmethod
+    def create(cls, ships, extra_attributes):
+        """Make and save the data for a size in a temporary directory"""
+        data = cls(tempfile.mkdtemp(prefix='wikiships-bench-'))
+        make_sde(data.db, ships, extra_attributes)
+        expected = attributes.expected_values(main.get_ships(data.db, snapshot=False))
+        pages = make_pages(expected)
+        infoboxes = dict((ship, infobox.parse(page)) for ship, page in pages.iteritems())
+        data._save('expected', expected)
+        data._save('pages', pages)
+        data._save('infoboxes', infoboxes)
+        #attributes cannot be pickled so are saved by name
+        wrong = formatters.Text().check(infoboxes, expected)
+        data._save('wrong', [(ship, [(i.attr.name, i.current, i.correct) for i in attrs])
+                             for ship, attrs in wrong.iteritems()])
+        return data
+
+    def load(self, parts):
+        """Load the saved parts as attributes"""
+        for part in parts:
+            with open(self._path(part), 'rb') as f:
+                setattr(self, part, pickle.load(f))
+        if 'wrong' in parts:
+            by_name = dict((i.name, i) for i in attributes.attributes)
+            self.wrong = collections.OrderedDict(
+                    (ship, [compare.WrongAttr(by_name[name], current, correct)
+                            for name, current, correct in attrs])
+                    for ship, attrs in self.wrong)
+
+    def close(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, part, value):
+        with open(self._path(part), 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+
+    def _path(self, part):
+        return path.join(self.directory, part + '.pickle')
+
+def bench_get_ships(data):
+    return len(main.get_ships(data.db, snapshot=False))
+
+def bench_parse(data):
+    for page in data.pages.itervalues():
+        infobox.parse(page)
+    return len(data.pages)
+
+def bench_extract(data):
+    for fields in data.infoboxes.itervalues():
+        for attr in attributes.attributes:
+            try:
+                attr.extract(fields)
+            except attributes.NotPresentError:
+                pass
+    return len(data.infoboxes) * len(attributes.attributes)
+
+def bench_check(data):
+    formatters.Text().check(data.infoboxes, data.expected)
+    return len(data.infoboxes) * len(attributes.attributes)
+
+def _bench_format(formatter):
+    def bench(data):
+        instance = formatter()
+        instance.pages = data.pages
+        instance.infoboxes = data.infoboxes
+        instance.format(data.wrong, [])
+        return sum(len(i) for i in data.wrong.itervalues())
+    bench.__doc__ = 'Time {}.format'.format(formatter.__name__)
+    return bench
+
+BENCHMARKS = [
+    ('get_ships', bench_get_ships, ()),
+    ('parse', bench_parse, ('pages',)),
+    ('extract', bench_extract, ('infoboxes',)),
+    ('check', bench_check, ('infoboxes', 'expected')),
+]
+"""(name, benchmark, the parts of Data it uses)"""
+BENCHMARKS.extend(('format_' + name.lower(), _bench_format(getattr(formatters, name)),
+                   ('pages', 'infoboxes', 'wrong'))
+                  for name in formatters.available())
+
+def run(name, directory, size, repeat):
+    """Run one benchmark in this process on the Data saved in directory
+
+    Returns:
+        (dict): the result, with the best time of repeat runs and the peak
+                memory after loading the data and after the benchmark
+
+    """
+    bench, parts = [i[1:] for i in BENCHMARKS if i[0] == name][0]
+    data = Data(directory)
+    data.load(parts)
+    setup_rss = profiling.peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        items = bench(data)
+        times.append(time.time() - start)
+    best = min(times)
+    return {
+        'benchmark': name,
+        'ships': size,
+        'items': items,
+        'seconds': best,
+        'mean_seconds': sum(times) / len(times),
+        'throughput': items / best if best else None,
+        'setup_peak_rss_kb': setup_rss,
+        'peak_rss_kb': profiling.peak_rss(),
+    }
+
+def _create(ships, extra_attributes):
+    return Data.create(ships, extra_attributes).directory
+
+def _in_process(func, *args):
+    """Call func in a fresh process, so its peak memory is its own and the
+    memory it uses is not inherited by the next one"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.terminate()
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=path.dirname(path.abspath(__file__)),
+                stderr=open(path.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main_():
+    parser = ArgumentParser(description='Benchmark wikiships on synthetic data',
+                            prog='python -m uni_wiki_ships.benchmark')
+    parser.add_argument('-s', '--sizes', default=','.join(str(i) for i in SIZES),
+            help='Comma separated numbers of ships. Defaults to {}'\
+                 .format(','.join(str(i) for i in SIZES)))
+    parser.add_argument('-a', '--attributes', default=100, type=int,
+            help='Attributes in the dump which are not used. Defaults to 100')
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+            help='Times to run each benchmark, the best is reported. Defaults to 3')
+    parser.add_argument('-b', '--benchmark', action='append',
+            choices=[i[0] for i in BENCHMARKS],
+            help='Benchmark to run, may be given more than once. Defaults to all')
+    parser.add_argument('-o', '--output', default='-',
+            help='File to write the JSON results to. Defaults to stdout')
+    args = parser.parse_args()
+    try:
+        sizes = [int(i) for i in args.sizes.split(',')]
+    except ValueError:
+        parser.error('Invalid sizes ' + args.sizes)
+    results = []
+    for size in sizes:
+        data = Data(_in_process(_create, size, args.attributes))
+        try:
+            for name in args.benchmark or [i[0] for i in BENCHMARKS]:
+                result = _in_process(run, name, data.directory, size, args.repeat)
+                sys.stderr.write('{benchmark} with {ships} ships: {seconds:.4f}s\n'\
+                                 .format(**result))
+                results.append(result)
+        finally:
+            data.close()
+    report = json.dumps({
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': formatters.compare.numpy is not None,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+if __name__ == '__main__':
+    main_()
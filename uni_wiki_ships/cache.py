@@ -0,0 +1,170 @@
+import cPickle as pickle
+import contextlib
+import errno
+import hashlib
+import logging
+import os
+import zlib
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+"""Format of the snapshot files, bump to invalidate existing snapshots"""
+
+CHUNK_SIZE = 1024 * 1024
+
+def file_hash(name, algorithm='sha1'):
+    """Hex digest of a file, read in chunks so large dumps are never held in memory"""
+    digest = hashlib.new(algorithm)
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Fingerprint(object):
+    """Identifies a version of a source file by its size, mtime and hash
+
+    The hash is only calculated when it is needed, as long as the size and
+    mtime match a stored fingerprint the file is assumed to be unchanged.
+
+    """
+
+    def __init__(self, source):
+        stat = os.stat(source)
+        self.source = source
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self._hash = None
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = file_hash(self.source)
+        return self._hash
+
+    def matches(self, stored):
+        """Check whether a stored fingerprint describes the same file
+
+        Args:
+            stored (dict): as returned by as_dict
+        Returns:
+            (bool): True if the file is unchanged
+
+        """
+        if stored.get('size') != self.size:
+            return False
+        if stored.get('mtime') == self.mtime:
+            return True
+        return stored.get('hash') == self.hash
+
+    def refresh(self, stored, update):
+        """Store the new mtime of a file which matches a stored fingerprint
+
+        A file with the same content but a new mtime has to be hashed to match,
+        storing the new mtime avoids hashing it again next time.
+
+        Args:
+            stored (dict): as returned by as_dict, which matches
+            update (callable): given this fingerprint, stores it in place of
+                            stored
+
+        """
+        if stored.get('mtime') != self.mtime:
+            update(self)
+
+    def as_dict(self):
+        return {'size': self.size, 'mtime': self.mtime, 'hash': self.hash}
+
+def load(name, source, key=None):
+    """Load a snapshot if it is still valid for the source file
+
+    Args:
+        name (str): path to the snapshot
+        source (str): path to the file the snapshot was derived from
+        key: any picklable value which must equal the one it was saved with
+    Returns:
+        the saved data or None when there is no valid snapshot
+
+    """
+    try:
+        with open(name, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != VERSION or header.get('key') != key:
+                logger.info('Snapshot %s is out of date', name)
+                return None
+            fingerprint = Fingerprint(source)
+            if not fingerprint.matches(header.get('source', {})):
+                logger.info('Snapshot %s is for a different %s', name, source)
+                return None
+            data = pickle.loads(zlib.decompress(f.read()))
+    except (EnvironmentError, EOFError, zlib.error, pickle.UnpicklingError,
+            AttributeError, ValueError) as e:
+        logger.debug('Could not load snapshot %s: %s', name, e)
+        return None
+    fingerprint.refresh(header['source'], lambda new: save(name, new, data, key))
+    logger.debug('Loaded snapshot %s', name)
+    return data
+
+def save(name, source, data, key=None):
+    """Atomically save a snapshot of data derived from a source file
+
+    Failures are logged rather than raised as a snapshot is only an
+    optimisation.
+
+    Args:
+        name (str): path to the snapshot
+        source (str or Fingerprint): the file the data was derived from
+        data: any picklable value
+        key: any picklable value which must be given to load
+
+    """
+    if not isinstance(source, Fingerprint):
+        source = Fingerprint(source)
+    header = {'version': VERSION, 'key': key, 'source': source.as_dict()}
+    try:
+        with replacing(name) as temp, open(temp, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            f.write(zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+    except EnvironmentError as e:
+        logger.warning('Could not save snapshot %s: %s', name, e)
+    else:
+        logger.debug('Saved snapshot %s', name)
+
+def replace(src, dst):
+    """Rename src to dst, replacing dst if it exists"""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        #Windows will not rename over an existing file
+        if e.errno != errno.EEXIST:
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+@contextlib.contextmanager
+def replacing(name):
+    """Give a temporary file to write instead of name, which replaces name
+    
+    The temporary file is in the same directory as name and replaces it at the
+    end of the with block, so name is never seen half written. If the block
+    raises the temporary file is removed and name left as it was, as it is if
+    the block removes the temporary file itself.
+    
+    Returns:
+        (str): path of the temporary file
+    
+    """
+    temp = '{}.{}.tmp'.format(name, os.getpid())
+    try:
+        yield temp
+        if os.path.exists(temp):
+            replace(temp, name)
+    except BaseException:
+        remove(temp)
+        raise
+
+def remove(name):
+    """Remove a file if it exists"""
+    try:
+        os.remove(name)
+    except OSError:
+        pass
@@ -0,0 +1,150 @@
+import attributes
+import collections
+import infobox
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+WrongAttr = collections.namedtuple('WrongAttr', ['attr', 'current', 'correct'])
+"""An incorrect attribute on a page, current is None if it is not on the page"""
+
+TOLERANCE = 1
+"""Values are only wrong if they differ by at least this much"""
+
+OUTCOMES = ('correct', 'wrong', 'missing')
+"""Outcomes counted for each attribute"""
+
+def compare(infoboxes, expected, attrs=None, counts=None):
+    """Compare the values on ship pages to the expected values
+
+    The expected and current values are loaded into ships x attributes
+    matrices and, if numpy is installed, compared in one vectorised pass. Only
+    the cells which may be wrong are then checked exactly and turned into
+    WrongAttr.
+
+    Args:
+        infoboxes (dict): {ship_name: fields} as returned by infobox.parse
+        expected (dict): {ship_name: {wiki_name: value}} as returned by
+                            attributes.expected_values
+        attrs (list): attributes to compare, defaults to attributes.attributes
+        counts (Counter): incremented for each (wiki_name, outcome) where
+                            outcome is one of OUTCOMES
+    Returns:
+        (OrderedDict): {ship_name: [WrongAttr]} sorted by ship name, with the
+                        attributes in the order of attrs
+
+    """
+    if attrs is None:
+        attrs = attributes.attributes
+    wrong = collections.OrderedDict()
+    names = sorted(infoboxes)
+    if not names or not attrs:
+        return wrong
+    expected = [[expected[name].get(attr.name) for attr in attrs] for name in names]
+    current = [[_extract(attr, infoboxes[name]) for attr in attrs] for name in names]
+    if numpy is None:
+        cells = ((i, j) for i in range(len(names)) for j in range(len(attrs)))
+    else:
+        cells = _candidates(expected, current)
+    if counts is None:
+        counts = collections.Counter()
+    for j, attr in enumerate(attrs):
+        counts[attr.name, 'correct'] += sum(1 for row in current if row[j] is not None)
+    for i, j in cells:
+        value, correct = current[i][j], expected[i][j]
+        if value is None:
+            if correct is None:
+                continue
+            outcome = 'missing'
+        elif value == correct or abs(value - (correct or 0)) < TOLERANCE:
+            continue
+        else:
+            outcome = 'wrong'
+            counts[attrs[j].name, 'correct'] -= 1
+        counts[attrs[j].name, outcome] += 1
+        wrong.setdefault(names[i], []).append(WrongAttr(attrs[j], value, correct))
+    return wrong
+
+def check_pages(pages, expected, pool=None, shards=1, counts=None):
+    """Parse pages and compare them to the expected values
+
+    With a pool the pages are split by ship into shards which are parsed and
+    compared in parallel, and the results merged in ship name order so they
+    are the same as without a pool. Attributes are always attributes.attributes
+    as only their names can be sent to other processes.
+
+    Args:
+        pages (dict): {ship_name: page_content} in wikitext
+        expected (dict): {ship_name: {wiki_name: value}} as returned by
+                            attributes.expected_values
+        pool (multiprocessing.Pool): pool to check in, or None to check here
+        shards (int): number of shards to split the pages into
+        counts (Counter): incremented as by compare
+    Returns:
+        (dict): {ship_name: fields} as returned by infobox.parse
+        (OrderedDict): {ship_name: [WrongAttr]} as returned by compare
+
+    """
+    if pool is None or shards < 2 or len(pages) < 2:
+        infoboxes = dict((ship, infobox.parse(page)) for ship, page in pages.iteritems())
+        return infoboxes, compare(infoboxes, expected, counts=counts)
+    names = sorted(pages)
+    size = -(-len(names) // shards)
+    work = [(dict((i, pages[i]) for i in names[start:start+size]),
+             dict((i, expected[i]) for i in names[start:start+size]))
+            for start in range(0, len(names), size)]
+    by_name = dict((attr.name, attr) for attr in attributes.attributes)
+    infoboxes = {}
+    wrong = collections.OrderedDict()
+    for shard_infoboxes, shard_wrong, shard_counts in pool.imap(_check_shard, work):
+        infoboxes.update(shard_infoboxes)
+        if counts is not None:
+            counts.update(shard_counts)
+        for ship, cells in shard_wrong:
+            wrong[ship] = [WrongAttr(by_name[name], value, correct)
+                           for name, value, correct in cells]
+    return infoboxes, wrong
+
+def _check_shard(shard):
+    """Check a shard of pages in a worker process for check_pages"""
+    pages, expected = shard
+    infoboxes = dict((ship, infobox.parse(page)) for ship, page in pages.iteritems())
+    counts = collections.Counter()
+    wrong = compare(infoboxes, expected, counts=counts)
+    return infoboxes, [(ship, [(i.attr.name, i.current, i.correct) for i in cells])
+                       for ship, cells in wrong.iteritems()], counts
+
+def _candidates(expected, current):
+    """Cells which may be wrong, found with numpy
+
+    A little slack is allowed so rounding in the floating point comparison
+    never hides a wrong value, the exact check is left to the caller.
+
+    Args:
+        expected (list): rows of expected Decimal values or None
+        current (list): rows of current Decimal values or None
+    Returns:
+        (iterator): of (row, column) in row major order
+
+    """
+    correct, has_correct = _matrix(expected)
+    value, has_value = _matrix(current)
+    differs = numpy.abs(value - numpy.where(has_correct, correct, 0)) >= TOLERANCE * 0.999
+    wrong = (has_value & differs) | (~has_value & has_correct)
+    return zip(*numpy.nonzero(wrong))
+
+def _matrix(rows):
+    """Dense float array of rows along with a mask of the values present"""
+    values = numpy.array([[numpy.nan if i is None else float(i) for i in row]
+                          for row in rows], dtype=float)
+    return numpy.nan_to_num(values), ~numpy.isnan(values)
+
+def _extract(attr, fields):
+    try:
+        return attr.extract(fields)
+    except attributes.NotPresentError:
+        return None
@@ -0,0 +1,293 @@
+import attributes
+import collections
+import compare
+import datetime
+import formatters
+import httpserver
+import infobox
+import json
+import logging
+import metrics
+import os
+import sqlite3
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from wiki import RequestError, TIMESTAMP_FORMAT
+logger = logging.getLogger(__name__)
+
+INTERVAL = 300
+"""Seconds between polls of the wiki for changes"""
+
+class Daemon(object):
+    """Keep the ship data and pages in memory and check pages as they change
+
+    The wiki is polled for recent changes and only the pages edited since the
+    last poll are fetched and checked again. The static dump is reloaded only
+    when its size or mtime changes, and then only ships whose expected values
+    changed are checked again. The results can be read at any time from other
+    threads, such as those of the HTTP server started by serve.
+
+    """
+
+    def __init__(self, wiki, db, load_expected, interval=INTERVAL):
+        """Create a daemon, call run to load everything and start polling
+
+        Args:
+            wiki (Wiki): the wiki to check, only used from the thread calling run
+            db (str): path to the static dump
+            load_expected (callable): given db returns the expected values, as
+                            main.get_expected
+            interval (float): seconds between polls of the wiki
+
+        """
+        self.wiki = wiki
+        self.db = db
+        self.interval = interval
+        self.load_expected = load_expected
+        self.expected = {}
+        self.pages = {}
+        self.wrong = {}
+        self.missing = set()
+        self.counts = {}
+        self.refreshes = 0
+        self.last_refresh = None
+        self.loaded = None
+        self._db_stat = None
+        self._since = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def run(self):
+        """Load everything then poll until stop is called"""
+        while not self._stopped:
+            try:
+                self.refresh()
+            except (urllib2.URLError, RequestError, ValueError, KeyError) as e:
+                logger.warning('Could not poll the wiki: %s', e)
+            except sqlite3.Error as e:
+                logger.error('Could not load %s: %s', self.db, e)
+            except EnvironmentError as e:
+                logger.error('Could not refresh: %s', e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def wake(self):
+        """Poll now instead of waiting for the interval"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def refresh(self):
+        """Reload the dump if it changed, then fetch and check changed pages"""
+        started = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+        recheck = self._reload()
+        if self._since is None:
+            fetch = set(self.expected)
+        else:
+            fetch = self.wiki.recent_changes(self._since) & set(self.expected)
+            #pages which could not be fetched last time
+            fetch.update(i for i in self.expected if i not in self.pages
+                         and i not in self.missing)
+        pages = {}
+        missing = []
+        if fetch:
+            for found, not_found in self.wiki.iter_pages(sorted(fetch)):
+                pages.update(found)
+                missing.extend(not_found)
+        self._check(recheck | fetch, pages, missing)
+        if not self.wiki.failed:
+            self._since = started
+        self.refreshes += 1
+        self.last_refresh = started
+        logger.info('Refreshed %s pages and checked %s ships', len(fetch),
+                    len(recheck | fetch))
+
+    def _reload(self):
+        """Reload the expected values if the dump changed
+
+        Returns:
+            (set): ships whose expected values changed
+
+        """
+        stat = os.stat(self.db)
+        stat = (stat.st_size, stat.st_mtime)
+        if stat == self._db_stat:
+            return set()
+        logger.info('Loading %s', self.db)
+        start = time.time()
+        expected = self.load_expected(self.db)
+        metrics.SDE_LOAD_SECONDS.set(time.time() - start)
+        changed = set(i for i in expected if expected[i] != self.expected.get(i))
+        with self._lock:
+            removed = set(self.expected) - set(expected)
+            self.expected = expected
+            for ship in removed:
+                self.pages.pop(ship, None)
+                self.wrong.pop(ship, None)
+                self.missing.discard(ship)
+                self.counts.pop(ship, None)
+        self._db_stat = stat
+        self.loaded = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+        return changed
+
+    def _check(self, ships, fetched, missing):
+        """Check ships against the latest pages and update the results"""
+        with self._lock:
+            pages = dict(self.pages)
+        pages.update(fetched)
+        for ship in missing:
+            pages.pop(ship, None)
+        wrong = {}
+        counts = {}
+        #checked one ship at a time to keep the counts of each, so the totals
+        #cover every page and not just those checked in this refresh
+        for ship in ships:
+            if ship in pages:
+                counts[ship] = collections.Counter()
+                wrong.update(compare.check_pages({ship: pages[ship]}, self.expected,
+                                                 counts=counts[ship])[1])
+        with self._lock:
+            self.pages = pages
+            self.missing.difference_update(fetched)
+            self.missing.update(missing)
+            for ship in ships:
+                if ship in wrong:
+                    self.wrong[ship] = wrong[ship]
+                else:
+                    self.wrong.pop(ship, None)
+                if ship in counts:
+                    self.counts[ship] = counts[ship]
+                else:
+                    self.counts.pop(ship, None)
+            total = sum(self.counts.itervalues(), collections.Counter())
+        for attr in attributes.attributes:
+            for outcome in compare.OUTCOMES:
+                metrics.CHECKS.set(total[attr.name, outcome],
+                                   attribute=attr.name, outcome=outcome)
+
+    def results(self):
+        """The latest results
+
+        Returns:
+            (OrderedDict): {ship_name: [WrongAttr]} sorted by ship name
+            (list): sorted ships without a page on the wiki
+
+        """
+        with self._lock:
+            return (collections.OrderedDict(sorted(self.wrong.iteritems())),
+                    sorted(self.missing))
+
+    def status(self):
+        with self._lock:
+            return {
+                'ships': len(self.expected),
+                'pages': len(self.pages),
+                'wrong': len(self.wrong),
+                'missing': len(self.missing),
+                'failed': list(self.wiki.failed),
+                'refreshes': self.refreshes,
+                'last_refresh': self.last_refresh,
+                'loaded': self.loaded,
+                'interval': self.interval,
+            }
+
+    def ship(self, name):
+        """Results for one ship, or None if there is no such ship"""
+        with self._lock:
+            if name not in self.expected:
+                return None
+            return {
+                'ship': name,
+                'expected': dict((k, str(v)) for k, v in self.expected[name].iteritems()),
+                'wrong': _wrong_json(self.wrong.get(name, [])),
+                'missing': name in self.missing,
+            }
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the results over HTTP on a background thread
+
+        The endpoints are /report, as JSON or in any single file format given
+        by ?format=, /ships/NAME, /status, /metrics and a POST to /refresh to
+        poll the wiki now.
+
+        Returns:
+            (HTTPServer): the server, shutdown to stop it
+
+        """
+        server = httpserver.Server((host, port), _Handler)
+        server.source = self
+        server.start('Daemon')
+        logger.info('Serving reports on http://%s:%s/', host, server.server_address[1])
+        return server
+
+def _wrong_json(wrong):
+    return [{'attribute': i.attr.name,
+             'current': None if i.current is None else str(i.current),
+             'correct': None if i.correct is None else str(i.correct)}
+            for i in wrong]
+
+class _Handler(httpserver.Handler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        daemon = self.server.source
+        if url.path in ('/', '/report'):
+            self._report(query.get('format', 'json'))
+        elif url.path.startswith('/ships/'):
+            ship = daemon.ship(urllib.unquote(url.path[len('/ships/'):]).decode('utf-8'))
+            if ship is None:
+                self._send(404, _json({'error': 'No such ship'}))
+            else:
+                self._send(200, _json(ship))
+        elif url.path == '/status':
+            self._send(200, _json(daemon.status()))
+        elif url.path == '/metrics':
+            self._send(200, metrics.REGISTRY.render().encode('utf-8'), metrics.CONTENT_TYPE)
+        else:
+            self._send(404, _json({'error': 'Not found'}))
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/refresh':
+            self._send(404, _json({'error': 'Not found'}))
+            return
+        self.server.source.wake()
+        self._send(202, _json({'refreshing': True}))
+
+    def _report(self, name):
+        wrong, missing = self.server.source.results()
+        if name == 'json':
+            self._send(200, _json({
+                'wrong': collections.OrderedDict((k, _wrong_json(v))
+                                                 for k, v in wrong.iteritems()),
+                'missing': missing,
+            }))
+            return
+        formatter = getattr(formatters, name.capitalize(), None)
+        if formatter is None or name.startswith('_') or formatter.MULTIPLE_FILES:
+            self._send(400, _json({'error': 'Invalid format {}'.format(name)}))
+            return
+        formatter = formatter()
+        pages = self.server.source.pages
+        formatter.pages = dict((i, pages[i]) for i in wrong if i in pages)
+        formatter.infoboxes = dict((k, infobox.parse(v))
+                                   for k, v in formatter.pages.iteritems())
+        wrong = collections.OrderedDict((k, v) for k, v in wrong.iteritems()
+                                        if k in pages)
+        output = formatter.format(wrong, missing)
+        self._send(200, output.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _json(value):
+    return json.dumps(value, indent=2)
@@ -0,0 +1,292 @@
+from hashlib import md5
+from ratelimit import TokenBucket
+from time import sleep
+import collections
+import datetime
+import gzip
+import httpserver
+import json
+import logging
+import random
+import threading
+import urlparse
+from StringIO import StringIO
+from wiki import TIMESTAMP_FORMAT
+logger = logging.getLogger(__name__)
+
+EDIT_TOKEN = 'fakeedittoken+\\'
+"""Token the fake wiki expects for edits"""
+
+class FakeWiki(object):
+    """Local stand in for the MediaWiki API used by wiki.Wiki
+
+    Serves the login, edit and query actions (revisions, info, edit tokens,
+    userinfo and recentchanges) at /w/api.php for pages held in memory, with
+    faults injected so the client can be tested without using the real wiki.
+    Every request is counted in stats.
+
+    """
+
+    def __init__(self, pages, port=0, latency=0, error_rate=0, rate=0, burst=1,
+                 lag_rate=0, lag=10, retry_after=1, high_limits=False, seed=None):
+        """Create the server, call start to serve in the background
+
+        Args:
+            pages (dict): {title: content} of the pages on the wiki
+            port (int): port to listen on, 0 for any free port
+            latency (float): seconds to wait before answering each request
+            error_rate (float): chance of a request failing with a HTTP 500
+            rate (float): requests per second allowed before answering with a
+                            HTTP 503, 0 for no limit
+            burst (int): requests allowed at once before rate applies
+            lag_rate (float): chance of the database being lagged by lag
+                            seconds for a request
+            lag (int): seconds of lag reported
+            retry_after (int): seconds clients are told to wait when throttled
+                            or lagged
+            high_limits (bool): whether users have the apihighlimits right
+            seed (int): seed for the injected faults
+
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lag_rate = lag_rate
+        self.lag = lag
+        self.retry_after = retry_after
+        self.high_limits = high_limits
+        self.limiter = TokenBucket(rate, burst)
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._revid = 0
+        self._changes = []
+        self._requested = collections.Counter()
+        self._failed_titles = collections.Counter()
+        self._pages = {}
+        for title, content in pages.iteritems():
+            self._save(title, content)
+        self._server = httpserver.Server(('127.0.0.1', port), _Handler)
+        self._server.wiki = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base url of the wiki to give to wiki.Wiki"""
+        return 'http://{}:{}'.format(*self._server.server_address)
+
+    @property
+    def pages(self):
+        """{title: content} of the current revision of every page"""
+        with self._lock:
+            return dict((title, page['content']) for title, page in self._pages.iteritems())
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = self._server.start('FakeWiki')
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        """Forget the requests counted so far"""
+        with self._lock:
+            self.stats.clear()
+            self._requested.clear()
+            self._failed_titles.clear()
+
+    def summary(self):
+        """Counts of the requests made so far
+
+        Returns:
+            (dict): stats along with title_retries, the number of times a
+                    title was queried again for the same properties, and
+                    title_failures, the number of times a title was in a
+                    query which failed with an injected fault
+
+        """
+        with self._lock:
+            summary = dict(self.stats)
+            summary['title_retries'] = sum(i - 1 for i in self._requested.values())
+            summary['title_failures'] = sum(self._failed_titles.values())
+        return summary
+
+    def handle(self, params):
+        """Answer an API request
+
+        Args:
+            params (dict): the parameters of the request
+        Returns:
+            (int): HTTP status
+            (dict): headers
+            (dict): the response to send as JSON
+
+        """
+        action = params.get('action')
+        self._count('requests')
+        self._count('action.{}'.format(action))
+        #titles are counted before any fault so retries of failed queries count
+        titles = []
+        if action == 'query' and params.get('titles'):
+            titles = [(params.get('prop'), i) for i in params['titles'].split('|')]
+            with self._lock:
+                self._requested.update(titles)
+        if self.latency:
+            sleep(self.latency)
+        fault = self._fault(params)
+        if fault is not None:
+            with self._lock:
+                self._failed_titles.update(titles)
+            return fault
+        handler = getattr(self, '_action_{}'.format(action), None)
+        if handler is None:
+            return 200, {}, _error('unknown_action', 'Unrecognized value for action')
+        return 200, {}, handler(params)
+
+    def _fault(self, params):
+        """An injected error to answer with, or None to answer normally"""
+        if not self.limiter.try_acquire():
+            self._count('throttled')
+            return 503, {'Retry-After': str(self.retry_after)}, {}
+        if self._chance(self.error_rate):
+            self._count('errors')
+            return 500, {}, {}
+        maxlag = params.get('maxlag')
+        if maxlag is not None and self._chance(self.lag_rate) and int(maxlag) < self.lag:
+            self._count('maxlag')
+            return 200, {'Retry-After': str(self.retry_after)}, {'error': {
+                'code': 'maxlag',
+                'info': 'Waiting for 127.0.0.1: {} seconds lagged'.format(self.lag)}}
+        return None
+
+    def _action_login(self, params):
+        if 'lgtoken' not in params:
+            return {'login': {'result': 'NeedToken', 'token': 'fakelogintoken'}}
+        if params['lgtoken'] != 'fakelogintoken':
+            return {'login': {'result': 'WrongToken'}}
+        return {'login': {'result': 'Success', 'lgusername': params.get('lgname')}}
+
+    def _action_query(self, params):
+        if params.get('meta') == 'userinfo':
+            rights = ['read', 'edit'] + (['apihighlimits'] if self.high_limits else [])
+            return {'query': {'userinfo': {'id': 1, 'name': 'Bot', 'rights': rights}}}
+        if params.get('list') == 'recentchanges':
+            return self._recent_changes(params)
+        props = set(params.get('prop', '').split('|'))
+        pages = {}
+        with self._lock:
+            for i, title in enumerate(params.get('titles', '').split('|')):
+                page = self._pages.get(title)
+                result = {'ns': 0, 'title': title}
+                if 'info' in props and params.get('intoken') == 'edit':
+                    result['edittoken'] = EDIT_TOKEN
+                if page is None:
+                    result['missing'] = ''
+                    pages[str(-i - 1)] = result
+                    continue
+                result['pageid'] = page['pageid']
+                if 'info' in props:
+                    result.update(lastrevid=page['revid'], length=len(page['content']))
+                if 'revisions' in props:
+                    result['revisions'] = [{'revid': page['revid'],
+                                            'timestamp': page['timestamp'],
+                                            '*': page['content']}]
+                pages[str(page['pageid'])] = result
+        return {'query': {'pages': pages}}
+
+    def _recent_changes(self, params):
+        since = params.get('rcstart', '')
+        with self._lock:
+            changes = [{'type': 'edit', 'ns': 0, 'title': title}
+                       for timestamp, title in self._changes if timestamp >= since]
+        return {'query': {'recentchanges': changes}}
+
+    def _action_edit(self, params):
+        title = params.get('title', '')
+        text = params.get('text', '')
+        if params.get('token') != EDIT_TOKEN:
+            return _error('badtoken', 'Invalid token')
+        if 'md5' in params and md5(text.encode('utf-8')).hexdigest() != params['md5']:
+            return _error('badmd5', 'The supplied MD5 hash was incorrect')
+        with self._lock:
+            page = self._pages.get(title)
+            if page and params.get('basetimestamp') \
+                    and params['basetimestamp'] != page['timestamp']:
+                self.stats['edit_conflicts'] += 1
+                return _error('editconflict', 'Edit conflict detected')
+            if page and page['content'] == text:
+                self.stats['edits_unchanged'] += 1
+                return {'edit': {'result': 'Success', 'title': title, 'nochange': ''}}
+            page = self._save(title, text)
+            self.stats['edits_saved'] += 1
+        return {'edit': {'result': 'Success', 'title': title,
+                         'newrevid': page['revid'], 'newtimestamp': page['timestamp']}}
+
+    def _save(self, title, content):
+        """Store a new revision of a page, the lock must be held once serving"""
+        self._revid += 1
+        timestamp = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+        page = self._pages.setdefault(title, {'pageid': len(self._pages) + 1})
+        page.update(revid=self._revid, timestamp=timestamp, content=content)
+        self._changes.append((timestamp, title))
+        return page
+
+    def _chance(self, rate):
+        with self._lock:
+            return rate and self._random.random() < rate
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+def _decode(params):
+    return [(k, v.decode('utf-8')) for k, v in params]
+
+def _error(code, info):
+    return {'error': {'code': code, 'info': info}}
+
+class _Handler(httpserver.Handler):
+    """Keep-alive handler passing API requests to the FakeWiki of the server"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._reply(self._params())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        params = self._params()
+        params.update(_decode(urlparse.parse_qsl(body, keep_blank_values=True)))
+        self._reply(params)
+
+    def _params(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/w/api.php':
+            return None
+        return dict(_decode(urlparse.parse_qsl(url.query, keep_blank_values=True)))
+
+    def _reply(self, params):
+        if params is None:
+            status, headers, response = 404, {}, {}
+        else:
+            status, headers, response = self.server.wiki.handle(params)
+        body = json.dumps(response)
+        if 'gzip' in (self.headers.getheader('Accept-Encoding') or ''):
+            compressed = StringIO()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+                f.write(body)
+            body = compressed.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        headers.update({'Content-Type': 'application/json; charset=utf-8',
+                        'Content-Length': str(len(body))})
+        if params and params.get('action') == 'login':
+            headers['Set-Cookie'] = 'fakewiki_session=1; Path=/'
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.wiki._lock:
+            self.server.wiki.stats['bytes_sent'] += len(body)
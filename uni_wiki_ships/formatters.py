@@ -2,13 +2,19 @@ from io import BytesIO
 from urllib import quote
 import attributes
 import collections
+import compare
 import csv
+import difflib
 import inspect
+import json
 import logging
+import multiprocessing
 import sys
 import os
 import errno
 import common
+import infobox
+import profiling
 logger = logging.getLogger(__name__)
 
 class InvalidLocation(common.AppException): pass
@@ -22,83 +28,141 @@ class _Formatter(object):
     MULTIPLE_FILES = False
     FILE_EXT = '.txt'
     
+    def __init__(self, workers=1):
+        """Create a formatter
+        
+        The outcome of every check is counted in counts, as by compare.compare.
+        
+        Args:
+            workers (int): processes to check pages in
+        
+        """
+        self.workers = workers
+        self.counts = collections.Counter()
+        self.profiler = profiling.Profiler(enabled=False)
+    
     def __call__(self, pages, ships, missing_pages, output_loc):
+        pool = self._start_pool()
+        try:
+            return self.format(
+                self._check_pages(pages, ships, pool), missing_pages
+            )
+        finally:
+            self._stop_pool(pool)
+    
+    def stream(self, batches, ships):
+        """Check and format batches of pages as they arrive
+        
+        Args:
+            batches (iterable): of (pages, missing_pages) as from Wiki.iter_pages
+            ships (dict): {ship_name: {wiki_name: value}} for expected values
+        Returns:
+            (iterator): the output in parts, which together are the same as
+                        the output of format for all the pages
+        
+        """
+        missing_pages = []
+        pool = self._start_pool()
+        try:
+            with self.profiler.stage('format'):
+                output = self.begin()
+            yield output
+            for pages, missing in batches:
+                missing_pages.extend(missing)
+                with self.profiler.stage('check', pages=len(pages)):
+                    wrong = self._check_pages(pages, ships, pool)
+                with self.profiler.stage('format'):
+                    output = self.format_wrong(wrong)
+                yield output
+            with self.profiler.stage('format'):
+                output = self.end(missing_pages)
+            yield output
+        finally:
+            self._stop_pool(pool)
+    
+    def _start_pool(self):
+        """Process pool for checking, None if there is only one worker"""
+        if self.workers > 1:
+            return multiprocessing.Pool(self.workers)
+    
+    def _stop_pool(self, pool):
+        if pool is not None:
+            pool.terminate()
+    
+    def _check_pages(self, pages, ships, pool):
+        """Parse and check pages, keeping them for format"""
         self.pages = pages
-        return self.format(
-            self.check(pages, ships), missing_pages
-        )
+        self.infoboxes, wrong = compare.check_pages(pages, ships, pool,
+                                                    self.workers * 4, self.counts)
+        return wrong
        
-    def check(self, pages, ships):
+    def check(self, infoboxes, ships):
         """Check the value for attributes on a ship wikipage
         
         Args:
-            pages (dict): {ship_name: page_content} in wikitext
-            ships (dict): {ship_name: {attribute_name: value}} for expected values
-            attributes (list): list of attributes
+            infoboxes (dict): {ship_name: fields} as returned by infobox.parse
+            ships (dict): {ship_name: {wiki_name: value}} for expected values
+                            as returned by attributes.expected_values
         Returns:
-            (dict): {ship_name: WrongAttr_tuple}
-                WrongAttr_tuple: a named tuple with
-                    (attribute_name, current_value, correct_value)
+            (OrderedDict): {ship_name: [WrongAttr]} sorted by ship name
+                WrongAttr: a named tuple with
+                    (attribute, current_value, correct_value)
             
         """
-        WrongAttr = collections.namedtuple('WrongAttr', ['attr', 'current', 'correct'])
-        wrong = collections.defaultdict(list)
-        for ship, page in pages.iteritems():
-            for attribute in attributes.attributes:
-                try:
-                    expected = attribute.process(ships[ship])
-                except attributes.NotPresentError:
-                    logger.debug('Ship %s has no value in db for %s', ship, attribute)
-                    expected = None
-                try:
-                    value = attribute.extract(page)
-                except attributes.NotPresentError:
-                    logger.info('%s has no value for %s', ship, attribute)
-                    if not expected == None:
-                        wrong[ship].append(WrongAttr(attribute, None, expected))
-                    continue
-                if not value == expected and abs(value - (expected or 0)) >= 1:
-                    logger.info('%s has incorrect value for %s', ship, attribute)
-                    wrong[ship].append(WrongAttr(attribute, value, expected))
-                else:
-                    logger.debug('%s has correct value for %s', ship, attribute)
-        return wrong
+        return compare.compare(infoboxes, ships, attributes.attributes, self.counts)
     
     def format(self, wrong_attrs, missing_pages):
         """Take incorrect attributes and output in correct format"""
+        return self.begin() + self.format_wrong(wrong_attrs) + self.end(missing_pages)
+    
+    def begin(self):
+        """Output before any results"""
+        return ''
+    
+    def format_wrong(self, wrong_attrs):
+        """Format some of the incorrect attributes"""
         raise NotImplementedError()
+    
+    def end(self, missing_pages):
+        """Output after all the results"""
+        return ''
                 
 class Text(_Formatter):
-    def format(self, wrong_attrs, missing_pages):
+    def format_wrong(self, wrong_attrs):
         """Format as a human-readable text string"""
         ret = []
         for k in wrong_attrs:
             for i in wrong_attrs[k]:
-                ret.append('{} has {} as {} but should be {}'\
+                ret.append('{} has {} as {} but should be {}\n'\
                       .format(k, i.attr, i.current, i.correct))
-        ret.append(', '.join(missing_pages) + 'are missing from wiki')
-        return '\n'.join(ret)    
+        return ''.join(ret)
+    
+    def end(self, missing_pages):
+        return ', '.join(missing_pages) + 'are missing from wiki'
     
 class Csv(_Formatter):
     FILE_EXT = '.csv'
     
-    def format(self, wrong_attrs, missing_pages):
+    def begin(self):
+        return self._rows([['Ship', 'Attribute', 'Current Value', 'Correct Value',
+                            'Link']])
+    
+    def format_wrong(self, wrong_attrs):
         """Format as CSV"""
+        return self._rows((k, i.attr, i.current, i.correct,
+                           'http://wiki.eveuniversity.org/'+quote(k))
+                          for k in wrong_attrs for i in wrong_attrs[k])
+    
+    def end(self, missing_pages):
+        return self._rows((i, 'Missing page', None, None,
+                           'http://wiki.eveuniversity.org/'+quote(i))
+                          for i in missing_pages)
+    
+    def _rows(self, rows):
+        """Write rows as CSV"""
         string = BytesIO()
         writer = csv.writer(string)
-        writer.writerow(['Ship', 'Attribute', 'Current Value', 'Correct Value',
-                         'Link'])
-        for k in wrong_attrs:
-            for i in wrong_attrs[k]:
-                row = (k, i.attr, i.current, i.correct,
-                       'http://wiki.eveuniversity.org/'+quote(k))
-                logger.debug('Row: '+', '.join(str(i) for i in row))
-                writer.writerow(row)
-        for i in missing_pages:
-            row = (i, 'Missing page', None, None,
-                   'http://wiki.eveuniversity.org/'+quote(i))
-            logger.debug('Row: '+', '.join(str(i) for i in row))
-            writer.writerow(row)
+        writer.writerows(rows)
         ret = string.getvalue()
         string.close()
         return ret
@@ -107,17 +171,93 @@ class Wikitext(_Formatter):
     MULTIPLE_FILES = True
     
     def format(self, wrong_attrs, missing_pages):
-        """Format as Wikitext"""
+        return self.format_wrong(wrong_attrs)
+    
+    def begin(self):
+        return {}
+    
+    def end(self, missing_pages):
+        return {}
+    
+    def format_wrong(self, wrong_attrs):
+        """Format as Wikitext
+        
+        Each page is rewritten in one pass with the numbers of its wrong
+        attributes corrected. Attributes with no correct value are left alone.
+        
+        """
         out = {}
         for k in wrong_attrs:
-            page = self.pages[k]
-            for i in wrong_attrs[k]:
-                correct = '{0:,.9999g}'.format(i.correct)
-                if correct.endswith('.0'): correct = correct[:-2]
-                page = i.attr.regex.sub(r'|{}={}'\
-                                    .format(i.attr, correct), page)
-            out[k] = page
+            out[k] = infobox.rewrite(self.pages[k], self.infoboxes[k],
+                                     _corrections(wrong_attrs[k]))
         return out
+
+class Patch(_Formatter):
+    """Unified diffs of the corrected infobox lines of each page, in one stream"""
+    FILE_EXT = '.patch'
+    CONTEXT = 0
+    """Unchanged lines shown around each change"""
+    
+    def format_wrong(self, wrong_attrs):
+        """Format as a unified diff"""
+        out = []
+        for k in wrong_attrs:
+            page = self.pages[k]
+            corrected = infobox.rewrite(page, self.infoboxes[k],
+                                        _corrections(wrong_attrs[k]))
+            if corrected != page:
+                #named as in wiki urls as patch stops reading names at a space
+                name = k.replace(' ', '_') + '.wiki'
+                for line in difflib.unified_diff(page.splitlines(True),
+                        corrected.splitlines(True), 'a/' + name, 'b/' + name,
+                        n=self.CONTEXT):
+                    out.append(line)
+                    #the last line of a page without a newline, marked as by diff
+                    if not line.endswith('\n'):
+                        out.append('\n\\ No newline at end of file\n')
+        return ''.join(out)
+
+class Edits(_Formatter):
+    """A JSON list of the edit to make to each field, in one stream"""
+    FILE_EXT = '.json'
+    
+    def begin(self):
+        self._separator = '[\n'
+        return ''
+    
+    def format_wrong(self, wrong_attrs):
+        """Format as JSON objects of the page, attribute, line, offsets and text"""
+        out = []
+        for k in wrong_attrs:
+            page = self.pages[k]
+            values = _corrections(wrong_attrs[k])
+            for start, end, name in infobox.spans(page, self.infoboxes[k], values):
+                out.append(self._separator + json.dumps({
+                    'page': k,
+                    'attribute': name,
+                    'line': page.count('\n', 0, start) + 1,
+                    'start': start,
+                    'end': end,
+                    'old': page[start:end],
+                    'new': values[name],
+                }, sort_keys=True))
+                self._separator = ',\n'
+        return ''.join(out)
+    
+    def end(self, missing_pages):
+        return '[]\n' if self._separator == '[\n' else '\n]\n'
+
+def _corrections(wrong):
+    """{wiki_name: number as written on the wiki} for wrong attributes with a
+    correct value"""
+    return dict((i.attr.name, _wiki_number(i.correct))
+                for i in wrong if i.correct is not None)
+
+def _wiki_number(value):
+    """A value as it is written on the wiki, with thousand separators"""
+    number = '{0:,.9999g}'.format(value)
+    if number.endswith('.0'): number = number[:-2]
+    return number
         
 if __name__ == '__main__':
     print('\n'.join(available()))
\ No newline at end of file
@@ -0,0 +1,29 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import logging
+import threading
+logger = logging.getLogger(__name__)
+
+class Server(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each request on its own daemon thread"""
+    daemon_threads = True
+
+    def start(self, name):
+        """Serve requests on a daemon thread
+
+        Args:
+            name (str): name of the thread
+        Returns:
+            (Thread): the thread serving, call shutdown to stop it
+
+        """
+        thread = threading.Thread(target=self.serve_forever, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class Handler(BaseHTTPRequestHandler):
+    """Request handler logging requests at debug level rather than to stderr"""
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
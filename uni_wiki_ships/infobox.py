@@ -0,0 +1,117 @@
+import collections
+import re
+
+Field = collections.namedtuple('Field', ['value', 'start', 'end'])
+"""A parameter of the infobox: its stripped value and the span of the raw value"""
+
+NUMBER = re.compile(r'\s*([\d,\.]+)')
+"""Numeric part at the start of a value, with thousand seperators and decimal points"""
+
+TEMPLATE = 'ShipBox'
+"""Start of the names of the templates making up the infobox"""
+
+_TOKENS = re.compile(r'\{\{|\}\}|\[\[|\]\]|\|')
+
+def parse(page):
+    """Tokenize the infobox of a wiki page in a single pass
+
+    The infobox is made up of the named parameters of the top level templates
+    on the page whose name starts with TEMPLATE, other templates are skipped.
+    Any parameters nested within links or other templates are part of the
+    enclosing value. When a name appears more than once the first one is used.
+
+    Args:
+        page (str): a wiki page
+    Returns:
+        (dict): {wiki_name: Field}
+
+    """
+    fields = {}
+    depth = links = 0
+    param = name = None
+    in_box = False
+    for token in _TOKENS.finditer(page):
+        kind = token.group()
+        if kind == '{{':
+            depth += 1
+            if depth == 1:
+                name = token.end()
+        elif kind == '[[':
+            links += depth > 0
+        elif kind == ']]':
+            links -= links > 0
+        elif depth == 1 and (kind == '}}' or not links):
+            if param is None:
+                in_box = _is_infobox(page[name:token.start()])
+            elif in_box:
+                _add_field(fields, page, param, token.start())
+            if kind == '}}':
+                depth = links = 0
+                param = None
+            else:
+                param = token.end()
+        elif kind == '}}':
+            depth -= depth > 0
+    return fields
+
+def _is_infobox(name):
+    """Whether a template name is part of the infobox"""
+    #the wiki ignores the case of the first letter and treats _ as a space
+    name = name.strip().replace('_', ' ')
+    return (name[:1].upper() + name[1:]).startswith(TEMPLATE)
+
+def _add_field(fields, page, start, end):
+    """Add the parameter at page[start:end] to fields if it is named"""
+    equals = page.find('=', start, end)
+    if equals == -1:
+        return
+    name = page[start:equals].strip()
+    if name and name not in fields:
+        fields[name] = Field(page[equals+1:end].strip(), equals + 1, end)
+
+def spans(page, fields, values):
+    """Spans of the numbers to replace in fields of the infobox
+
+    Args:
+        page (str): a wiki page
+        fields (dict): {wiki_name: Field} as returned by parse(page)
+        values (dict): {wiki_name: replacement text for the number}
+    Returns:
+        (list): of (start, end, wiki_name) in order, for the fields which are
+                on the page and start with a number
+
+    """
+    found = []
+    for name in values:
+        field = fields.get(name)
+        if field is None:
+            continue
+        number = NUMBER.match(page, field.start, field.end)
+        if number:
+            found.append((number.start(1), number.end(1), name))
+    found.sort()
+    return found
+
+def rewrite(page, fields, values):
+    """Replace the numeric part of fields of the infobox in a single pass
+
+    The page is copied once, with everything but the replaced numbers left
+    exactly as it was. Fields which are not on the page or do not start with a
+    number are left alone.
+
+    Args:
+        page (str): a wiki page
+        fields (dict): {wiki_name: Field} as returned by parse(page)
+        values (dict): {wiki_name: replacement text for the number}
+    Returns:
+        (str): the rewritten page
+
+    """
+    parts = []
+    last = 0
+    for start, end, name in spans(page, fields, values):
+        parts.append(page[last:start])
+        parts.append(values[name])
+        last = end
+    parts.append(page[last:])
+    return ''.join(parts)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Run wikiships against a local fake wiki and report how it performed
+
+Usage:
+    python -m uni_wiki_ships.loadtest [options] [-- WIKISHIPS_OPTIONS]
+
+Creates a synthetic static dump and ship pages, serves the pages from a
+fakewiki.FakeWiki with the latency, errors, throttling and lag asked for, then
+runs wikiships against it one or more times. For each run the pages per second
+and the requests seen by the wiki are reported as JSON, including retries and
+how often titles were queried again or were in a query which failed.
+Options after -- are passed to wikiships, e.g. "-- -f wikitext -o wiki -u a -p b"
+to also time edits.
+
+"""
+
+from argparse import ArgumentParser, REMAINDER
+from os import path
+import attributes
+import benchmark
+import fakewiki
+import json
+import main
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def run(wiki, db, page_store, wikiships_args):
+    """Run wikiships once against wiki
+
+    Returns:
+        (dict): seconds taken, exit status and the requests the wiki saw
+
+    """
+    wiki.reset()
+    command = [sys.executable, '-m', 'uni_wiki_ships.main', '--wiki', wiki.url,
+               '--db', db, '--page-store', page_store, '-r', '0'] + wikiships_args
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call(command, stdout=devnull,
+                                 cwd=path.dirname(path.dirname(path.abspath(__file__))))
+    seconds = time.time() - start
+    return {'seconds': seconds, 'status': status, 'wiki': wiki.summary()}
+
+def main_():
+    parser = ArgumentParser(description='Run wikiships against a local fake wiki',
+                            prog='python -m uni_wiki_ships.loadtest')
+    parser.add_argument('-s', '--ships', default=500, type=int,
+            help='Number of ships, each with a page. Defaults to 500')
+    parser.add_argument('-n', '--runs', default=2, type=int,
+            help='Times to run wikiships, later runs use the page store from '
+                 'earlier ones. Defaults to 2')
+    parser.add_argument('--latency', default=0.05, type=float,
+            help='Seconds the wiki takes to answer each request. Defaults to 0.05')
+    parser.add_argument('--error-rate', default=0, type=float,
+            help='Chance of each request failing with a HTTP 500')
+    parser.add_argument('--rate', default=0, type=float,
+            help='Requests per second the wiki allows before throttling')
+    parser.add_argument('--burst', default=1, type=int,
+            help='Requests the wiki allows at once before the rate applies')
+    parser.add_argument('--lag-rate', default=0, type=float,
+            help='Chance of each request being refused for maxlag')
+    parser.add_argument('--high-limits', action='store_true',
+            help='Give the user apihighlimits')
+    parser.add_argument('--seed', default=0, type=int,
+            help='Seed for the data and the injected faults')
+    parser.add_argument('-o', '--output', default='-',
+            help='File to write the JSON report to. Defaults to stdout')
+    parser.add_argument('wikiships_args', nargs=REMAINDER,
+            help='Options for wikiships, after --')
+    args = parser.parse_args()
+    wikiships_args = args.wikiships_args
+    if wikiships_args[:1] == ['--']:
+        wikiships_args = wikiships_args[1:]
+    directory = tempfile.mkdtemp(prefix='wikiships-loadtest-')
+    try:
+        db = path.join(directory, 'eve.db')
+        benchmark.make_sde(db, args.ships, seed=args.seed)
+        expected = attributes.expected_values(main.get_ships(db, snapshot=False))
+        wiki = fakewiki.FakeWiki(benchmark.make_pages(expected, seed=args.seed),
+                latency=args.latency, error_rate=args.error_rate, rate=args.rate,
+                burst=args.burst, lag_rate=args.lag_rate,
+                high_limits=args.high_limits, seed=args.seed)
+        wiki.start()
+        try:
+            runs = []
+            for i in range(args.runs):
+                result = run(wiki, db, path.join(directory, 'pages.db'), wikiships_args)
+                result['pages_per_second'] = len(expected) / result['seconds']
+                sys.stderr.write('Run {}: {:.1f} pages/s, {} requests, {} title '
+                                 'retries\n'.format(i + 1, result['pages_per_second'],
+                                                    result['wiki'].get('requests'),
+                                                    result['wiki']['title_retries']))
+                runs.append(result)
+        finally:
+            wiki.stop()
+    finally:
+        shutil.rmtree(directory)
+    report = json.dumps({
+        'ships': len(expected),
+        'settings': dict((k, v) for k, v in vars(args).iteritems()
+                         if k not in ('output', 'wikiships_args')),
+        'wikiships_args': wikiships_args,
+        'runs': runs,
+    }, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+if __name__ == '__main__':
+    main_()
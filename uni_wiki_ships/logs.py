@@ -0,0 +1,67 @@
+import Queue
+import atexit
+import logging
+import threading
+
+LEVELS = ('debug', 'info', 'warning', 'error', 'critical')
+"""Names of the levels that can be chosen on the command line"""
+
+class AsyncHandler(logging.Handler):
+    """Hand records to another handler on a background thread
+
+    Logging only puts the record on a queue, formatting it and writing it out
+    are done by the thread so they never hold up the caller. Call close, which
+    happens at exit, to flush the remaining records.
+
+    """
+
+    def __init__(self, target):
+        """Create the handler and start its thread
+
+        Args:
+            target (logging.Handler): handler to pass records to
+
+        """
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='AsyncHandler')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+def setup(filename, level='info'):
+    """Log everything at level or above to filename without blocking
+
+    Args:
+        filename (str): file to append the log to
+        level (str): one of LEVELS
+
+    """
+    level = getattr(logging, level.upper())
+    log = logging.getLogger()
+    log.setLevel(level)
+    filelog = logging.FileHandler(filename)
+    filelog.setLevel(level)
+    filelog.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log.addHandler(AsyncHandler(filelog))
@@ -10,8 +10,10 @@ Argument OUTPUT:
 Options:
     -h, --help             Print help message and exit
     -f, --format [FORMAT]  Select the format. May be any function starting 'format_'
-    -p, --pause  [TIME]    Time in secssto pause between queries to wiki.
-                            Defaults to 10.
+    -r, --rate   [RATE]    Maximum requests per second to the wiki.
+                            Defaults to 1.
+    -j, --concurrency [N]  Maximum requests to the wiki at once.
+                            Defaults to 4.
 
 """
 
@@ -19,23 +21,82 @@ from argparse import ArgumentParser
 from decimal import Decimal
 from os import path
 from urllib import quote
+import attributes
+import bz2
+import cache
+import compare
+import daemon
 import datetime
 import formatters
+import hashlib
+import httplib
 import json
 import logging
+import logs
+import metrics
+import os
+import profiling
+import socket
 import sqlite3
 import sys
+import time
 import urllib2
+from common import AppException
 from formatters import InvalidLocation
+from pagestore import PageStore
 import outputters
 from outputters import InvalidSetup
-from wiki import Wiki, RequestError
+from wiki import Wiki, RequestError, TIMESTAMP_FORMAT, USER_AGENT
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
+class DownloadError(AppException): pass
+
 REMOTE_DATABASE_LOC = 'https://www.fuzzwork.co.uk/dump/odyssey-1.1-91288/odyssey11.sqlite.bz2'
 """Location of static dump"""
 
+LOCAL_DATABASE_LOC = path.join(path.dirname(__file__), 'eve.db')
+"""Location of the local copy of the static dump"""
+
+PAGE_STORE_LOC = path.join(path.dirname(__file__), 'pages.db')
+"""Location of the local copy of wiki pages"""
+
+WIKI_LOC = 'http://wiki.eveuniversity.org'
+"""Base url of the wiki to check"""
+
+SHIP_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS wikiships_invGroups_categoryID '
+    'ON invGroups (categoryID, groupID)',
+    'CREATE INDEX IF NOT EXISTS wikiships_invTypes_groupID '
+    'ON invTypes (groupID, published)',
+    'CREATE INDEX IF NOT EXISTS wikiships_dgmTypeAttributes_typeID '
+    'ON dgmTypeAttributes (typeID, attributeID, valueInt, valueFloat)',
+)
+"""Indexes covering the ship query, created in the static dump on first use"""
+
+EXTRACT_TABLES = (
+    'CREATE TABLE invGroups AS SELECT groupID, categoryID '
+    'FROM sde.invGroups WHERE categoryID = 6',
+    'CREATE TABLE invTypes AS SELECT typeID, groupID, typeName, mass, capacity, '
+    'volume, published FROM sde.invTypes WHERE published = 1 '
+    'AND groupID IN (SELECT groupID FROM invGroups)',
+    'CREATE TABLE dgmTypeAttributes AS SELECT typeID, attributeID, valueInt, '
+    'valueFloat FROM sde.dgmTypeAttributes '
+    'WHERE typeID IN (SELECT typeID FROM invTypes)',
+    'CREATE TABLE dgmAttributeTypes AS SELECT attributeID, attributeName '
+    'FROM sde.dgmAttributeTypes '
+    'WHERE attributeID IN (SELECT attributeID FROM dgmTypeAttributes)',
+    'CREATE UNIQUE INDEX wikiships_dgmAttributeTypes_attributeName '
+    'ON dgmAttributeTypes (attributeName, attributeID)',
+)
+"""Statements copying the ship rows of the static dump, attached as sde, into an extract"""
+
+SNAPSHOT_EXT = '.ships'
+"""Extension added to the database path for the snapshot of get_ships"""
+
+EXPECTED_EXT = '.expected'
+"""Extension added to the database path for the table of get_expected"""
+
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
 
@@ -69,81 +130,508 @@ def query_yes_no(question, default="yes"):
             sys.stdout.write("Please respond with 'yes' or 'no' "\
                              "(or 'y' or 'n').\n")
 
-def get_ships(db=path.join(path.dirname(__file__), 'eve.db')):
+def get_ships(db=LOCAL_DATABASE_LOC, db_attrs=None,
+              snapshot=True):
     """Extract ship attributes from database
     
+    Only the attributes asked for are fetched, with one row per ship pivoted by
+    SQLite. If an up to date extract built by build_extract exists it is queried
+    instead of the full database. The result is snapshotted next to the
+    database and reused until the database or the attributes asked for change.
+    
     Args:
-        db_attrs (list): valid attributes to return
+        db_attrs (list): valid attributes to return, defaults to the db names
+                            of attributes.attributes
         db (str): path to database
+        snapshot (bool): whether to use and update the snapshot
     Returns:
         (dict): format of {ship_name: {attribute_name: value}}
         
     """
+    if db_attrs is None:
+        db_attrs = [i.db_name for i in attributes.attributes]
+    db_attrs = sorted(set(db_attrs))
+    source = _ship_source(db)
+    snapshot_loc = db + SNAPSHOT_EXT
+    if snapshot and path.exists(source):
+        ships = cache.load(snapshot_loc, source, db_attrs)
+        if ships is not None:
+            return ships
+    ships = _query_ships(source, db_attrs)
+    if snapshot:
+        cache.save(snapshot_loc, source, ships, db_attrs)
+    return ships
+
+def get_expected(db=LOCAL_DATABASE_LOC):
+    """Get the values expected on the wiki for every ship
+    
+    The table is computed once from get_ships and saved next to the database,
+    then reused until the database or the definitions of the attributes change.
+    
+    Args:
+        db (str): path to database
+    Returns:
+        (dict): format of {ship_name: {wiki_name: value}}
+    
+    """
+    source = _ship_source(db)
+    table_loc = db + EXPECTED_EXT
+    key = attributes.config_hash()
+    if path.exists(source):
+        expected = cache.load(table_loc, source, key)
+        if expected is not None:
+            return expected
+    expected = attributes.expected_values(get_ships(db))
+    cache.save(table_loc, source, expected, key)
+    return expected
+
+def _ship_source(db):
+    """The database get_ships should query, the extract of db if it is up to date"""
+    extract = extract_location(db)
+    if not path.exists(extract):
+        return db
+    if not path.exists(db):
+        return extract
+    try:
+        extract_conn = sqlite3.connect(extract)
+        try:
+            row = extract_conn.execute(
+                'SELECT size, mtime, hash FROM wikishipsSource').fetchone()
+        finally:
+            extract_conn.close()
+    except sqlite3.Error as e:
+        logger.warning('Ignoring invalid extract %s: %s', extract, e)
+        return db
+    fingerprint = cache.Fingerprint(db)
+    stored = dict(zip(('size', 'mtime', 'hash'), row or ()))
+    if row and fingerprint.matches(stored):
+        fingerprint.refresh(stored, lambda new: _update_source_mtime(extract, new.mtime))
+        return extract
+    logger.warning('Extract %s is out of date, run "wikiships extract"', extract)
+    return db
+
+def _update_source_mtime(extract, mtime):
+    """Record a new mtime for the unchanged source of extract"""
+    try:
+        extract_conn = sqlite3.connect(extract)
+        try:
+            extract_conn.execute('UPDATE wikishipsSource SET mtime = ?', (mtime,))
+            extract_conn.commit()
+        finally:
+            extract_conn.close()
+    except sqlite3.Error as e:
+        logger.debug('Could not update extract %s: %s', extract, e)
+
+def _query_ships(db, db_attrs):
+    """Query the database for get_ships"""
     try:
         db_conn = sqlite3.connect(db)
+        _create_indexes(db_conn)
+        wanted = db_conn.execute(
+            'SELECT attributeID, attributeName FROM dgmAttributeTypes '
+            'WHERE attributeName IN ({})'.format(', '.join('?' * len(db_attrs))),
+            db_attrs).fetchall()
+        ids = [i[0] for i in wanted]
+        columns = ['types.typeName', 'types.mass', 'types.capacity', 'types.volume']
+        columns.extend(
+            'MAX(CASE attTypes.attributeID WHEN ? THEN '
+            'COALESCE(NULLIF(attTypes.valueInt, 0), NULLIF(attTypes.valueFloat, 0), 0) '
+            'END)' for i in ids)
         db_ships = db_conn.execute(
-            'SELECT types.typeName, types.mass, types.capacity, types.volume, '
-            'attributes.attributeName, attTypes.valueInt, attTypes.valueFloat '
+            'SELECT ' + ', '.join(columns) + ' '
             'FROM invTypes types '
-            'INNER JOIN dgmTypeAttributes attTypes ON attTypes.typeID = types.typeID '
-            'INNER JOIN dgmAttributeTypes attributes ON attributes.attributeID = attTypes.attributeID '
             'INNER JOIN invGroups ON types.groupID = invGroups.groupID '
-            'WHERE invGroups.categoryID = 6 AND types.published = 1 ')
+            'INNER JOIN dgmTypeAttributes attTypes ON attTypes.typeID = types.typeID '
+            'WHERE invGroups.categoryID = 6 AND types.published = 1 '
+            'AND attTypes.attributeID IN ({}) '
+            'GROUP BY types.typeID'.format(', '.join('?' * len(ids))),
+            ids + ids)
+        names = [i[1] for i in wanted]
         ships = {}
         for i in db_ships:
-            ships[i[0]] = ships.get(i[0], {'mass':i[1], 'capacity':i[2], 'volume':i[3]})
-            try:
-                ships[i[0]][i[4]] = Decimal(str(i[5] or i[6] or 0))
-            except TypeError:
-                phrase = 'Invalid value for {} on {} with value {}'.format(i[4], i[0], i[5] or i[6])
-                logger.warning(phrase)
+            ship = ships[i[0]] = {'mass':i[1], 'capacity':i[2], 'volume':i[3]}
+            for name, value in zip(names, i[4:]):
+                if value is None:
+                    continue
+                try:
+                    ship[name] = Decimal(str(value))
+                except TypeError:
+                    phrase = 'Invalid value for {} on {} with value {}'.format(name, i[0], value)
+                    logger.warning(phrase)
     
     finally:
         db_conn.close()
     
     return ships
 
-def get_database(remote=REMOTE_DATABASE_LOC, local=path.join(path.dirname(__file__), 'eve.db')):
-    from bz2 import decompress
+def _create_indexes(db_conn):
+    """Create the indexes get_ships relies on if the database allows it"""
+    try:
+        for index in SHIP_INDEXES:
+            db_conn.execute(index)
+        db_conn.commit()
+    except sqlite3.OperationalError as e:
+        logger.debug('Could not create indexes: %s', e)
+
+def extract_location(db):
+    """Path of the ship only extract of the database db"""
+    root, ext = path.splitext(db)
+    return root + '_ships' + ext
+
+def build_extract(db=LOCAL_DATABASE_LOC, extract=None):
+    """Build a small database containing only the ships from db
+    
+    The extract has the same tables as the static dump, restricted to published
+    types in the ship category, their groups, all of their attributes and the
+    types of those attributes, along with the indexes get_ships uses. The
+    fingerprint of db is recorded so get_ships only uses an up to date extract.
+    
+    Args:
+        db (str): path to the full database
+        extract (str): path to save the extract to, defaults to
+                            extract_location(db)
+    Throws:
+        sqlite3.Error: db is not a valid static dump
+    
+    """
+    if extract is None:
+        extract = extract_location(db)
+    if not path.exists(db):
+        raise sqlite3.OperationalError('No database at ' + db)
+    fingerprint = cache.Fingerprint(db)
+    logger.info('Building extract of %s in %s', db, extract)
+    with cache.replacing(extract) as temp:
+        extract_conn = sqlite3.connect(temp)
+        try:
+            extract_conn.execute('ATTACH DATABASE ? AS sde', (db,))
+            for statement in EXTRACT_TABLES:
+                extract_conn.execute(statement)
+            for index in SHIP_INDEXES:
+                extract_conn.execute(index)
+            extract_conn.execute(
+                'CREATE TABLE wikishipsSource (size INTEGER, mtime REAL, hash TEXT)')
+            extract_conn.execute('INSERT INTO wikishipsSource VALUES (?, ?, ?)',
+                    (fingerprint.size, fingerprint.mtime, fingerprint.hash))
+            extract_conn.commit()
+            extract_conn.execute('DETACH DATABASE sde')
+            extract_conn.execute('VACUUM')
+        finally:
+            extract_conn.close()
+
+def get_database(remote=REMOTE_DATABASE_LOC, local=LOCAL_DATABASE_LOC, checksum=None):
+    """Download and decompress the static dump
+    
+    The compressed dump is streamed into a partial file next to local, which is
+    resumed with a HTTP range request if a previous download was interrupted.
+    It is then verified and decompressed into a temporary file which replaces
+    local, so local is only ever a complete database. A download which is cut
+    short keeps the partial file, and only one which is complete but fails the
+    checksum is thrown away.
+    
+    Args:
+        remote (str): url of the bzipped dump
+        local (str): path to save the database to
+        checksum (str): md5 of the compressed dump, fetched from remote.md5
+                            when not given
+    Throws:
+        DownloadError: the dump could not be fetched or is corrupt
+        
+    """
+    part = local + '.bz2.part'
     logger.info('Fetching %s into %s', remote, local)
-    req = urllib2.Request(remote, headers={'User-Agent' : "E-Uni Wiki Bot"}) 
-    with open(local, 'wb') as local_file:
+    if checksum is None:
+        checksum = _get_checksum(remote)
+    _download(remote, part)
+    if checksum:
+        actual = cache.file_hash(part, 'md5')
+        if actual != checksum.lower():
+            os.remove(part)
+            raise DownloadError('Checksum of {} was {} but should be {}'\
+                                .format(remote, actual, checksum))
+    else:
+        logger.warning('No checksum for %s, not verifying it', remote)
+    try:
+        with cache.replacing(local) as temp:
+            _decompress(part, temp)
+    except EOFError as e:
+        #the download was cut short without the server saying how long it was
+        raise DownloadError('Incomplete dump from {}, run again to resume: {}'\
+                            .format(remote, e))
+    except IOError as e:
+        os.remove(part)
+        raise DownloadError('Invalid dump from {}: {}'.format(remote, e))
+    os.remove(part)
+
+def _get_checksum(remote):
+    """Fetch the md5 published alongside remote, or None if there is not one"""
+    req = urllib2.Request(remote + '.md5', headers={'User-Agent' : USER_AGENT})
+    try:
+        return urllib2.urlopen(req).read().split()[0]
+    except (urllib2.URLError, IndexError) as e:
+        logger.debug('No checksum for %s: %s', remote, e)
+        return None
+
+def _download(remote, part):
+    """Stream remote into part, resuming from the end of part if it exists
+    
+    Throws:
+        DownloadError: the download failed or ended before all of it was
+                            received, part keeps what was received
+    
+    """
+    try:
+        offset = path.getsize(part)
+    except OSError:
+        offset = 0
+    headers = {'User-Agent' : USER_AGENT}
+    if offset:
+        logger.info('Resuming download from byte %s', offset)
+        headers['Range'] = 'bytes={}-'.format(offset)
+    try:
+        response = urllib2.urlopen(urllib2.Request(remote, headers=headers))
+    except urllib2.HTTPError as e:
+        if e.code == 416 and offset:
+            #range starts at the end of the file, nothing left to fetch
+            return
+        raise DownloadError('Error fetching {}. The server said: {}'\
+                            .format(remote, e.fp.read()))
+    except urllib2.URLError as e:
+        raise DownloadError('Error fetching {}: {}'.format(remote, e.reason))
+    except (socket.error, httplib.HTTPException) as e:
+        raise DownloadError('Error fetching {}: {}'.format(remote, e))
+    #servers ignoring the range send the whole file again
+    resumed = response.getcode() == 206
+    expected = _expected_length(response.info(), resumed, offset)
+    received = 0
+    with open(part, 'ab' if resumed else 'wb') as part_file:
         try:
-            local_file.write(decompress(urllib2.urlopen(req).read())) 
-        except urllib2.HTTPError, e:
-            print('Error fetching webpage. The server said:')
-            print(e.fp.read())
+            for chunk in iter(lambda: response.read(cache.CHUNK_SIZE), b''):
+                part_file.write(chunk)
+                received += len(chunk)
+        except (socket.error, httplib.HTTPException) as e:
+            raise DownloadError('Download of {} failed after {} bytes, run again '
+                                'to resume: {}'.format(remote, received, e))
+    if expected is not None and received < expected:
+        raise DownloadError('Download of {} stopped after {} of {} bytes, run '
+                            'again to resume'.format(remote, received, expected))
+
+def _expected_length(headers, resumed, offset):
+    """Bytes the body of a download should have, or None if it is not known"""
+    if resumed:
+        #Content-Range: bytes start-end/total
+        total = (headers.getheader('Content-Range') or '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total) - offset
+    length = headers.getheader('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+def _decompress(source, dest):
+    """Incrementally decompress the bzipped file source into dest"""
+    decompressor = bz2.BZ2Decompressor()
+    with open(source, 'rb') as compressed, open(dest, 'wb') as decompressed:
+        for chunk in iter(lambda: compressed.read(cache.CHUNK_SIZE), b''):
+            decompressed.write(decompressor.decompress(chunk))
+    if not _finished(decompressor):
+        raise EOFError('compressed data ended before the end of the stream')
+
+def _finished(decompressor):
+    """Whether a BZ2Decompressor has reached the end of its stream"""
+    try:
+        decompressor.decompress(b'')
+    except EOFError:
+        return True
+    return False
         
+def ship_hash(values):
+    """Hash of the expected values for a ship, to tell when they change"""
+    return hashlib.sha1(repr(sorted(values.items()))).hexdigest()
+
+def changed_ships(wiki, store, ships):
+    """Ships whose page or data have changed since the last run
+    
+    Args:
+        wiki (Wiki): the wiki to ask for recent changes
+        store (PageStore): the store recording previous runs
+        ships (dict): {ship_name: {wiki_name: value}} expected values
+    Returns:
+        (list): names of the ships to check, all of them if there is no
+                    previous run
+    
+    """
+    since = store.watermark()
+    if since is None:
+        logger.info('No previous run, checking every ship')
+        return ships.keys()
+    checked = store.checked_hashes()
+    edited = wiki.recent_changes(since)
+    names = [i for i in ships
+             if i in edited or checked.get(i) != ship_hash(ships[i])]
+    logger.info('%s ships changed since %s', len(names), since)
+    return names
+
+LOG_LOC = path.join(path.dirname(__file__), 'log.txt')
+"""File the log is written to"""
+
+def _load_expected(db, profiler):
+    """get_expected, timed for the profile and metrics"""
+    start = time.time()
+    with profiler.stage('sde_load'):
+        ships = get_expected(db)
+    metrics.SDE_LOAD_SECONDS.set(time.time() - start)
+    return ships
+
+def _add_log_level(parser):
+    parser.add_argument('--log-level', action='store', default='info',
+            choices=logs.LEVELS, help='Least severe messages to log to {}. '
+                                      'Defaults to info'.format(LOG_LOC))
+
+def _add_wiki_args(parser):
+    parser.add_argument('-r', '--rate', default=1, type=float,
+            help='Maximum requests per second to the wiki, 0 for no limit. '
+                 'Defaults to 1', action='store')
+    parser.add_argument('--burst', default=1, type=int,
+            help='Requests that may be made at once before the rate applies. '
+                 'Defaults to 1', action='store')
+    parser.add_argument('-j', '--concurrency', default=4, type=int,
+            help='Maximum requests to the wiki at once. Defaults to 4',
+            action='store')
+    parser.add_argument('--wiki', action='store', default=WIKI_LOC,
+            help='Base url of the wiki. Defaults to {}'.format(WIKI_LOC))
+    parser.add_argument('--db', action='store', default=LOCAL_DATABASE_LOC,
+            help='Path to the static dump')
+    parser.add_argument('--page-store', action='store', default=PAGE_STORE_LOC,
+            help='Local copy of wiki pages, only changed pages are downloaded')
+    parser.add_argument('--no-page-store', action='store_true',
+            help='Download every page without using the page store')
+    parser.add_argument('-u', '--user', action='store',
+            help='Username of the wiki user')
+    parser.add_argument('-p', '--password', action='store',
+            help='Password of the wiki user')
+
+def _open_wiki(parser, args, profiler=None):
+    """Wiki for the options added by _add_wiki_args, logged in if a user was given"""
+    profiler = profiler or profiling.Profiler(enabled=False)
+    store = None
+    if not args.no_page_store:
+        try:
+            store = PageStore(args.page_store)
+        except sqlite3.Error as e:
+            parser.error('Invalid page store {}: {}'.format(args.page_store, e))
+    wiki = Wiki(args.wiki.rstrip('/'), args.rate, args.concurrency,
+                args.burst, store)
+    wiki.profiler = profiler
+    if args.user and args.password:
+        try:
+            with profiler.stage('login'):
+                wiki.login(args.user, args.password)
+        except RequestError as e:
+            parser.error(e)
+    return wiki
+
+def extract_main(argv):
+    """wikiships extract: build the ship only extract of the static dump"""
+    parser = ArgumentParser(description='Build a ship only extract of the static dump',
+                            prog='wikiships extract')
+    parser.add_argument('--db', action='store', default=LOCAL_DATABASE_LOC,
+            help='Path to the static dump')
+    parser.add_argument('--extract', action='store',
+            help='Path to save the extract to, defaults to next to the dump')
+    _add_log_level(parser)
+    args = parser.parse_args(argv)
+    logs.setup(LOG_LOC, args.log_level)
+    try:
+        build_extract(args.db, args.extract)
+    except sqlite3.Error as e:
+        parser.error('Could not build extract from {}: {}'.format(args.db, e))
+    print('Done!')
+
+def serve_main(argv):
+    """wikiships serve: keep checking the wiki and serve the results"""
+    parser = ArgumentParser(description='Keep the ship data and pages in memory, '
+                            'check pages as they change and serve the results',
+                            prog='wikiships serve')
+    _add_wiki_args(parser)
+    parser.add_argument('--interval', default=daemon.INTERVAL, type=float,
+            help='Seconds between polls of the wiki for changes. Defaults to '
+                 '{}'.format(daemon.INTERVAL), action='store')
+    parser.add_argument('--port', default=8765, type=int,
+            help='Port on localhost to serve the results on. Defaults to 8765',
+            action='store')
+    _add_log_level(parser)
+    args = parser.parse_args(argv)
+    logs.setup(LOG_LOC, args.log_level)
+    try:
+        get_expected(args.db)
+    except sqlite3.Error as e:
+        parser.error('Invalid static dump {}: {}'.format(args.db, e))
+    server = daemon.Daemon(_open_wiki(parser, args), args.db, get_expected,
+                           args.interval)
+    try:
+        server.serve(args.port)
+    except EnvironmentError as e:
+        parser.error('Could not serve on port {}: {}'.format(args.port, e))
+    print('Serving on http://127.0.0.1:{}/'.format(args.port))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.wiki.store is not None:
+            server.wiki.store.close()
+
+COMMANDS = {
+    'extract': extract_main,
+    'serve': serve_main,
+}
+"""Subcommands of wikiships, given as the first argument"""
+
 def main():
-    log = logging.getLogger()
-    log.setLevel(logging.DEBUG)
-    filelog = logging.FileHandler(path.join(path.dirname(__file__), 'log.txt'))
-    filelog.setLevel(logging.DEBUG)
-    filelog.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    log.addHandler(filelog)
-    
-    parser = ArgumentParser(description='Find incorrect ships on wiki', prog="wikiships")
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+    
+    parser = ArgumentParser(description='Find incorrect ships on wiki', prog="wikiships",
+            epilog='Other commands: {}'.format(', '.join(sorted(COMMANDS))))
     parser.add_argument('-F', '--file', action='store',
             help='File to save output to, use "stdout" to print to screen')
     parser.add_argument('-f', '--format', action='store', default='text',
             help='Format for the output')
     parser.add_argument('-o', '--output', action='store', default='stdout',
             help='How to output text')
-    parser.add_argument('--pause', default=1, type=int,
-            help='Number of seconds to wait between requests to wiki. '
-                 'Defaults to 30', action='store')
-    parser.add_argument('-u', '--user', action='store',
-            help='Username of the wiki user')
-    parser.add_argument('-p', '--password', action='store',
-            help='Password of the wiki user')
+    _add_wiki_args(parser)
+    parser.add_argument('--workers', default=1, type=int,
+            help='Number of processes to check pages in. Defaults to 1',
+            action='store')
+    parser.add_argument('--since-last-run', action='store_true',
+            help='Only check ships whose page or data changed since the last run')
+    parser.add_argument('--profile', action='store', metavar='FILE',
+            help='Write the wall and CPU time of each stage to FILE as JSON')
+    parser.add_argument('--profile-cprofile', action='store', metavar='FILE',
+            help='Write cProfile stats of the run to FILE')
+    parser.add_argument('--profile-memory', action='store', metavar='FILE',
+            help='Write a tracemalloc snapshot at the end of the run to FILE')
+    parser.add_argument('--metrics-file', action='store', metavar='FILE',
+            help='Write Prometheus metrics to FILE at the end of the run')
+    parser.add_argument('--metrics-port', action='store', type=int, metavar='PORT',
+            help='Serve Prometheus metrics on localhost:PORT while running')
+    _add_log_level(parser)
     args = parser.parse_args()
+    logs.setup(LOG_LOC, args.log_level)
     logger.debug('Args: %s', args)
+    run_start = time.time()
+    if args.metrics_port is not None:
+        metrics.REGISTRY.serve(args.metrics_port)
+    if args.profile_memory and profiling.tracemalloc is None:
+        parser.error('--profile-memory needs tracemalloc')
+    profiler = profiling.Profiler(bool(args.profile), args.profile_cprofile,
+                                  args.profile_memory)
+    profiler.start()
     args.password
     try:
-        formatter = getattr(formatters, args.format.capitalize())()
+        formatter = getattr(formatters, args.format.capitalize())(args.workers)
     except AttributeError:
         parser.error('Invalid format please choose from {}'\
                   .format(', '.join([i for i in formatters.available()])))
+    formatter.profiler = profiler
     
     try:
         outputter = getattr(outputters, args.output.capitalize())
@@ -152,36 +640,44 @@ def main():
                   .format(args.output, ', '.join([i for i in outputters.available()])))
         
     try:
-        ships = get_ships()
+        ships = _load_expected(args.db, profiler)
     except sqlite3.Error:
         if not query_yes_no('No valid local database, '
                             'should it be downloaded (~100mb file)?'):
             parser.exit()
-        get_database(REMOTE_DATABASE_LOC)
-        print('Done!')
-        ships = get_ships()
+        try:
+            get_database(REMOTE_DATABASE_LOC, args.db)
+        except DownloadError as e:
+            parser.error(e)
+        try:
+            build_extract(args.db)
+        except sqlite3.Error as e:
+            logger.warning('Could not build extract: %s', e)
+        sys.stderr.write('Done!\n')
+        ships = _load_expected(args.db, profiler)
         
-    wiki = Wiki('http://wiki.eveuniversity.org', args.pause)
-    try:
-        user = args.user
-        password = args.password
-    except AttributeError:
-        pass
-    else:
-        if user and password:
-            try:
-                wiki.login(user, password)
-            except RequestError as e:
-                parser.error(e)
+    if args.since_last_run and args.no_page_store:
+        parser.error('--since-last-run needs the page store')
+    wiki = _open_wiki(parser, args, profiler)
+    store = wiki.store
     
     try:
         outputter = outputter(args.file, formatter, wiki)
     except outputters.InvalidSetup as e:
         parser.error(e)
         
-    pages, missing_pages = wiki.get_pages(ships.keys())
+    started = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    names = ships.keys()
+    if args.since_last_run:
+        try:
+            names = changed_ships(wiki, store, ships)
+        except RequestError as e:
+            parser.error('Could not get recent changes: {}'.format(e))
     try:
-        outputter(formatter(pages, ships, missing_pages, args.file))
+        with profiler.stage('stream'):
+            batches = profiler.produced(wiki.iter_pages(names), 'fetch')
+            outputter.stream(profiler.consumed(formatter.stream(batches, ships),
+                                               'output'))
     except EnvironmentError as e:
         try:
             filename = e.filename
@@ -190,6 +686,33 @@ def main():
         parser.error('Error accessing file {}: {}'.format(filename, e.strerror))
     except InvalidLocation as e:
         parser.error('Invalid location {}: {}'.format(args.file, e))
+    for attr in attributes.attributes:
+        logger.info('%s: %s correct, %s wrong, %s missing', attr,
+                    *[formatter.counts[attr.name, i] for i in compare.OUTCOMES])
+        for outcome in compare.OUTCOMES:
+            metrics.CHECKS.set(formatter.counts[attr.name, outcome],
+                               attribute=attr.name, outcome=outcome)
+    if wiki.failed:
+        sys.stderr.write('Could not fetch, run again to check: {}\n'\
+                         .format(', '.join(wiki.failed)))
+    if store is not None:
+        #forget the hash of pages which failed to be fetched or edited so they
+        #are checked next time
+        failed = set(wiki.failed) | set(outputter.failed)
+        store.finish_run(started, dict((i, None if i in failed else ship_hash(ships[i]))
+                                       for i in names))
+        store.close()
+    profiler.finish(args.profile)
+    metrics.RUN_SECONDS.set(time.time() - run_start)
+    metrics.LAST_RUN.set(time.time())
+    if args.metrics_file:
+        try:
+            metrics.REGISTRY.write(args.metrics_file)
+        except EnvironmentError as e:
+            logger.error('Could not write metrics to %s: %s', args.metrics_file, e)
+    if outputter.failed:
+        parser.exit(1, 'Could not edit {} pages, run again to retry them\n'\
+                       .format(len(outputter.failed)))
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,187 @@
+import cache
+import httpserver
+import logging
+import threading
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""Content type of the Prometheus text format"""
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Upper bounds in seconds of the request latency histogram buckets"""
+
+class Registry(object):
+    """Metrics which are exported together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """The metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, _escape(metric.help)))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    labels = '{' + ','.join('{}="{}"'.format(k, _escape(v, True))
+                                            for k, v in labels) + '}'
+                lines.append('{}{}{} {}'.format(metric.name, suffix, labels or '',
+                                                _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, name):
+        """Write the metrics to a file, replacing it atomically
+
+        The file can be read by the textfile collector of the node exporter.
+
+        """
+        with cache.replacing(name) as temp, open(temp, 'w') as f:
+            f.write(self.render().encode('utf-8'))
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics over HTTP on a background thread
+
+        Returns:
+            (HTTPServer): the server, shutdown to stop it
+
+        """
+        server = httpserver.Server((host, port), _Handler)
+        server.registry = self
+        server.start('Metrics')
+        logger.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+        return server
+
+REGISTRY = Registry()
+"""Registry of the metrics of wikiships"""
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        """Create a metric and add it to registry
+
+        Args:
+            name (str): name of the metric
+            help (str): description of the metric
+            labels (tuple): names of the labels every sample must be given
+
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labels:
+            self._values[()] = self._initial()
+        registry.register(self)
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} needs labels {}'.format(self.name, ', '.join(self.labels)))
+        return tuple(unicode(labels[i]) for i in self.labels)
+
+    def samples(self):
+        """The samples of the metric
+
+        Returns:
+            (list): of (name suffix, [(label, value)], value)
+
+        """
+        with self._lock:
+            return [('', zip(self.labels, key), value)
+                    for key, value in sorted(self._values.iteritems())]
+
+class Counter(_Metric):
+    """A count which only goes up"""
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """A value which may go up or down"""
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """Counts of observations in buckets along with their sum"""
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        _Metric.__init__(self, name, help, labels, registry)
+
+    def _initial(self):
+        #count in each bucket, then the sum
+        return [0] * len(self.buckets) + [0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, self._initial())
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for _, labels, counts in _Metric.samples(self):
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', labels + [('le', _number(bound))], count))
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, counts[-2]))
+        return samples
+
+REQUESTS = Counter('wikiships_wiki_requests_total',
+                   'Requests made to the wiki API', ('action', 'result'))
+REQUEST_SECONDS = Histogram('wikiships_wiki_request_seconds',
+                            'Time taken by requests to the wiki API', ('action',))
+PAGES = Counter('wikiships_pages_total',
+                'Ship pages by how they were got: fetched, stored (unchanged '
+                'since stored), missing from the wiki or failed', ('result',))
+CHECKS = Gauge('wikiships_attribute_checks',
+               'Attributes checked in the last run by outcome', ('attribute', 'outcome'))
+EDITS = Counter('wikiships_edits_total',
+                'Edits to the wiki: saved, skipped as unchanged or failed', ('result',))
+FILES = Counter('wikiships_files_total',
+                'Output files: written or skipped as unchanged', ('result',))
+SDE_LOAD_SECONDS = Gauge('wikiships_sde_load_seconds',
+                         'Time taken to load the expected values from the static dump')
+RUN_SECONDS = Gauge('wikiships_run_seconds', 'Time taken by the last run')
+LAST_RUN = Gauge('wikiships_last_run_timestamp_seconds',
+                 'Unix time the last run finished')
+
+class _Handler(httpserver.Handler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _escape(value, quotes=False):
+    value = unicode(value).replace('\\', r'\\').replace('\n', r'\n')
+    return value.replace('"', r'\"') if quotes else value
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -1,9 +1,19 @@
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import cache
 import common
 import errno
+import hashlib
 import inspect
 import logging
+import metrics
 import os
 import sys
+import tarfile
+import threading
+import time
+import wiki
+import zipfile
 logger = logging.getLogger(__name__)
 
 class InvalidSetup(common.AppException): pass
@@ -25,37 +35,160 @@ class _Outputter(object):
         self.multiple_files = formatter.MULTIPLE_FILES
         self.formatter = formatter
         self.wiki = wiki
+        self.failed = []
         self._validate()
     
+    def __call__(self, output):
+        self.stream([output])
+    
+    def stream(self, outputs):
+        """Output each part of the output as it is produced
+        
+        Args:
+            outputs (iterable): parts of the output as from _Formatter.stream
+        
+        Pages which could not be output are left in failed.
+        
+        """
+        raise NotImplementedError()
+    
     def _validate(self):
         pass 
         
 class File(_Outputter):
-    def __call__(self, output):
-        logger.debug(output)
-        if self.multiple_files:
-            try:
-                os.mkdir(self.argument)
-            except OSError as e:
-                if e.errno != errno.EEXIST or os.path.isfile(self.argument):
-                    raise 
-            for name, content in output.iteritems():
-                self._write_file(os.path.join(self.argument,
-                        name+self.formatter.FILE_EXT), content)
+    """Write to a file, or a file for each page in a directory or an archive
+    
+    Files are written to a temporary file which then replaces them, so an
+    interrupted run never leaves a file half written, and files whose content
+    has not changed are not written at all. Files in a directory are written
+    by a small pool of threads. If the path ends in one of ARCHIVES the files
+    are written into that archive instead of a directory.
+    
+    """
+    ARCHIVES = ('.zip', '.tar', '.tar.gz', '.tgz')
+    IO_THREADS = 4
+    """Files written at once"""
+    
+    def stream(self, outputs):
+        if not self.multiple_files:
+            self._write_single(outputs)
+        elif self.argument.endswith(self.ARCHIVES):
+            self._write_archive(outputs)
         else:
-            self._write_file(self.argument, output)
-                
-    def _write_file(self, name, content):
-        with open(name, 'w') as f:
-            f.write(content.encode('UTF-8'))
+            self._write_directory(outputs)
+    
+    def _write_single(self, outputs):
+        digest = hashlib.sha1()
+        with cache.replacing(self.argument) as temp:
+            with open(temp, 'wb') as f:
+                for output in outputs:
+                    logger.debug(output)
+                    data = output.encode('UTF-8')
+                    digest.update(data)
+                    f.write(data)
+                size = f.tell()
+            unchanged = _unchanged(self.argument, size, digest.hexdigest())
+            if unchanged:
+                logger.info('%s is unchanged', self.argument)
+                os.remove(temp)
+        metrics.FILES.inc(result='unchanged' if unchanged else 'written')
+    
+    def _write_directory(self, outputs):
+        try:
+            os.mkdir(self.argument)
+        except OSError as e:
+            if e.errno != errno.EEXIST or os.path.isfile(self.argument):
+                raise 
+        pool = ThreadPool(self.IO_THREADS)
+        write, pending = _limited(_write_file, self.IO_THREADS * 2)
+        results = []
+        try:
+            for output in outputs:
+                logger.debug(output)
+                for name, content in output.iteritems():
+                    pending.acquire()
+                    results.append(pool.apply_async(write, (
+                            os.path.join(self.argument, name+self.formatter.FILE_EXT),
+                            content.encode('UTF-8'))))
+            written = sum(result.get() for result in results)
+        finally:
+            pool.terminate()
+        logger.info('Wrote %s files, skipped %s unchanged', written,
+                    len(results) - written)
+    
+    def _write_archive(self, outputs):
+        with cache.replacing(self.argument) as temp:
+            if self.argument.endswith('.zip'):
+                archive = zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED)
+                add = archive.writestr
+            else:
+                archive = tarfile.open(temp, 'w:gz' if self.argument.endswith('gz') else 'w')
+                def add(name, data):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    archive.addfile(info, BytesIO(data))
+            try:
+                for output in outputs:
+                    logger.debug(output)
+                    for name, content in output.iteritems():
+                        add((name+self.formatter.FILE_EXT).encode('UTF-8'),
+                            content.encode('UTF-8'))
+            finally:
+                archive.close()
+        metrics.FILES.inc(result='written')
         
     def _validate(self):
         if not self.argument:
             raise InvalidSetup('Need to pass path to file')
+        if self.argument.endswith(self.ARCHIVES) and not self.multiple_files:
+            raise InvalidSetup('Archives need a format with a file for each page')
+
+def _limited(func, limit):
+    """Limit the calls of func waiting for a pool, as each holds a whole page
+    
+    Returns:
+        (callable): func, to give to the pool
+        (BoundedSemaphore): to acquire before giving each call to the pool,
+                            released when the call finishes
+    
+    """
+    pending = threading.BoundedSemaphore(limit)
+    def call(*args):
+        try:
+            return func(*args)
+        finally:
+            pending.release()
+    return call, pending
+
+def _write_file(name, data):
+    """Replace the file name with data unless it already has that content
+    
+    Returns:
+        (bool): whether the file was written
+    
+    """
+    if _unchanged(name, len(data), hashlib.sha1(data).hexdigest()):
+        metrics.FILES.inc(result='unchanged')
+        return False
+    with cache.replacing(name) as temp, open(temp, 'wb') as f:
+        f.write(data)
+    metrics.FILES.inc(result='written')
+    return True
+
+def _unchanged(name, size, digest):
+    """Whether the file name has the given size and sha1 digest"""
+    try:
+        return os.path.getsize(name) == size and cache.file_hash(name) == digest
+    except EnvironmentError:
+        return False
 
 class Stdout(_Outputter):
-    def __call__(self, text):
-        print(text)
+    def stream(self, outputs):
+        for text in outputs:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        print('')
     
     def _validate(self):
         if self.multiple_files:
@@ -69,6 +202,48 @@ class Wiki(_Outputter):
         if not self.multiple_files:
             raise InvalidSetup('Must edit multiple wiki pages')
         
-    def __call__(self, output):
-        for name, content in output.iteritems():
-            self.wiki.edit_page(name, content)
\ No newline at end of file
+    def stream(self, outputs):
+        """Edit the pages in output which have changed
+        
+        Pages identical to the revision fetched are skipped, the rest are
+        edited concurrently by the wiki as soon as they are produced, based on
+        the fetched revision so edits made since then are not overwritten.
+        Failed edits are reported at the end and their titles left in failed.
+        
+        """
+        pool = ThreadPool(self.wiki.concurrency)
+        edit, pending = _limited(self._edit, self.wiki.concurrency * 2)
+        results = []
+        skipped = 0
+        try:
+            for output in outputs:
+                for name, content in output.iteritems():
+                    fetched = self.wiki.fetched.get(name)
+                    if fetched and fetched.md5 == wiki.content_md5(content):
+                        logger.info('Skipping unchanged page %s', name)
+                        metrics.EDITS.inc(result='skipped')
+                        skipped += 1
+                        continue
+                    self.wiki.edit_token()
+                    pending.acquire()
+                    results.append(pool.apply_async(edit,
+                            (name, content, fetched and fetched.timestamp)))
+            failed = [i for i in (result.get() for result in results) if i]
+        finally:
+            pool.terminate()
+        logger.info('Edited %s pages, skipped %s unchanged',
+                    len(results) - len(failed), skipped)
+        self.failed = [name for name, _ in failed]
+        for name, error in failed:
+            sys.stderr.write('Could not edit {}: {}\n'.format(name, error))
+    
+    def _edit(self, name, content, basetimestamp):
+        """Make one edit, returning (name, error) if it failed"""
+        try:
+            self.wiki.edit_page(name, content, basetimestamp)
+        #ValueError and KeyError are replies which are not JSON or not an edit
+        except (wiki.RequestError, EnvironmentError, ValueError, KeyError) as e:
+            logger.warning('Could not edit %s: %s', name, e)
+            metrics.EDITS.inc(result='failed')
+            return name, e
+        metrics.EDITS.inc(result='saved')
@@ -0,0 +1,93 @@
+import collections
+import logging
+import sqlite3
+import zlib
+logger = logging.getLogger(__name__)
+
+Page = collections.namedtuple('Page', ['revid', 'timestamp', 'content'])
+"""A stored revision of a wiki page"""
+
+class PageStore(object):
+    """Local copy of wiki pages along with the revision they were taken from
+
+    Pages are kept in a SQLite database with zlib compressed content. The store
+    also records when each run started and a hash of the data each page was
+    last checked against, so later runs can skip what has not changed. The
+    store must only be used from the thread which created it.
+
+    """
+
+    def __init__(self, name):
+        """Open a store, creating it if needed
+
+        Args:
+            name (str): path to the database
+
+        """
+        self.name = name
+        self._conn = sqlite3.connect(name)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'title TEXT PRIMARY KEY, revid INTEGER, timestamp TEXT, content BLOB)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS runs (started TEXT)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS checked (title TEXT PRIMARY KEY, hash TEXT)')
+        self._conn.commit()
+
+    def get(self, title):
+        """Get the stored revision of a page
+
+        Args:
+            title (str): the page title
+        Returns:
+            (Page): the page or None if it is not stored
+
+        """
+        row = self._conn.execute(
+            'SELECT revid, timestamp, content FROM pages WHERE title = ?',
+            (title,)).fetchone()
+        if row is None:
+            return None
+        return Page(row[0], row[1], zlib.decompress(row[2]).decode('utf-8'))
+
+    def put(self, title, revid, timestamp, content):
+        """Store a revision of a page, replacing any earlier one"""
+        self._conn.execute(
+            'INSERT OR REPLACE INTO pages (title, revid, timestamp, content) '
+            'VALUES (?, ?, ?, ?)',
+            (title, revid, timestamp,
+             sqlite3.Binary(zlib.compress(content.encode('utf-8')))))
+
+    def watermark(self):
+        """Start time of the last finished run, or None if there has not been one"""
+        return self._conn.execute('SELECT MAX(started) FROM runs').fetchone()[0]
+
+    def checked_hashes(self):
+        """Hashes of the data each page was last checked against
+
+        Returns:
+            (dict): {title: hash}
+
+        """
+        return dict(self._conn.execute('SELECT title, hash FROM checked'))
+
+    def finish_run(self, started, hashes):
+        """Record a finished run
+
+        Args:
+            started (str): when the run started as a wiki timestamp
+            hashes (dict): {title: hash} of the data the pages were checked against
+
+        """
+        self._conn.execute('INSERT INTO runs (started) VALUES (?)', (started,))
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO checked (title, hash) VALUES (?, ?)',
+            hashes.iteritems())
+        self._conn.commit()
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,173 @@
+from time import time
+import cProfile
+import collections
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+logger = logging.getLogger(__name__)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class Profiler(object):
+    """Record the wall and CPU time of each stage of a run
+
+    Each stage is recorded as an event along with any counts added to it, such
+    as bytes fetched. CPU time is for the whole process so stages recorded from
+    other threads should not ask for it. When disabled nothing is recorded and
+    the profiler costs next to nothing, so code can always use one.
+
+    """
+
+    def __init__(self, enabled=True, cprofile=None, snapshot=None):
+        """Create a profiler
+
+        Args:
+            enabled (bool): whether to record stages
+            cprofile (str): file to dump cProfile stats of the run to
+            snapshot (str): file to dump a tracemalloc snapshot to at the end
+                            of the run, needs tracemalloc
+
+        """
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.snapshot = snapshot
+        self.events = []
+        self.started = time()
+        self._profile = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self):
+        """Start timing the run, and cProfile and tracemalloc if asked for"""
+        self.started = time()
+        if self.snapshot:
+            tracemalloc.start()
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name, cpu=True, **counts):
+        """Record the time taken by the body of a with statement
+
+        Args:
+            name (str): the stage
+            cpu (bool): whether to record CPU time and peak memory
+            counts: initial counts for the stage
+        Returns:
+            (dict): the event recorded for the stage
+
+        """
+        if not self.enabled:
+            yield {}
+            return
+        event = dict(counts, stage=name)
+        stack = self._stack()
+        stack.append(event)
+        start = time()
+        start_cpu = _cpu_time() if cpu else None
+        try:
+            yield event
+        finally:
+            stack.pop()
+            event['start'] = start - self.started
+            event['wall'] = time() - start
+            if cpu:
+                event['cpu'] = _cpu_time() - start_cpu
+                event['peak_rss_kb'] = peak_rss()
+            with self._lock:
+                self.events.append(event)
+
+    def add(self, name, amount=1):
+        """Add to a count of the innermost stage running in this thread"""
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[-1][name] = stack[-1].get(name, 0) + amount
+
+    def produced(self, iterable, name):
+        """Record the time taken to produce each item of iterable as a stage"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def consumed(self, iterable, name):
+        """Record the time taken by the consumer of each item of iterable as a stage"""
+        for item in iterable:
+            with self.stage(name):
+                yield item
+
+    def report(self):
+        """Summary of the run
+
+        Returns:
+            (dict): the totals for the run, stages with the number of events
+                    and totals of their times and counts, and every event
+                    in the order they started
+
+        """
+        with self._lock:
+            events = sorted(self.events, key=lambda i: i['start'])
+        stages = collections.OrderedDict()
+        for event in events:
+            totals = stages.setdefault(event['stage'], collections.Counter())
+            totals['events'] += 1
+            for name, value in event.iteritems():
+                if name not in ('stage', 'start', 'peak_rss_kb') \
+                        and isinstance(value, (int, long, float)):
+                    totals[name] += value
+        return {
+            'wall': time() - self.started,
+            'cpu': _cpu_time(),
+            'peak_rss_kb': peak_rss(),
+            'stages': stages,
+            'events': events,
+        }
+
+    def finish(self, name=None):
+        """Stop profiling and write out everything asked for
+
+        Args:
+            name (str): file to write the JSON report to, None for no report
+
+        """
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile)
+            logger.info('Wrote cProfile stats to %s', self.cprofile)
+        if self.snapshot:
+            tracemalloc.take_snapshot().dump(self.snapshot)
+            tracemalloc.stop()
+            logger.info('Wrote tracemalloc snapshot to %s', self.snapshot)
+        if name:
+            with open(name, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+            logger.info('Wrote profile to %s', name)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+def _cpu_time():
+    """User and system CPU time of the process so far"""
+    return sum(os.times()[:2])
+
+def peak_rss():
+    """Peak resident memory of the process in KB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #macOS reports bytes rather than KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
@@ -0,0 +1,56 @@
+from time import sleep, time
+import threading
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter
+
+    Tokens are added at a constant rate up to a maximum of capacity, and each
+    request takes one. This allows a short burst of up to capacity requests
+    while keeping the long term rate at or below rate.
+
+    """
+
+    def __init__(self, rate, capacity=1):
+        """Create a bucket, initially full
+
+        Args:
+            rate (float): tokens added per second, 0 or None for no limit
+            capacity (int): the maximum number of tokens stored
+
+        """
+        self.rate = float(rate or 0)
+        self.capacity = max(capacity, 1)
+        self._tokens = float(self.capacity)
+        self._last = time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, blocking until they are available"""
+        if not self.rate:
+            return
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return
+            sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """Take tokens from the bucket if they are available now
+
+        Returns:
+            (bool): whether the tokens were taken
+
+        """
+        return not self.rate or not self._take(tokens)
+
+    def _take(self, tokens):
+        """Take tokens if there are enough, else return the seconds until there are"""
+        with self._lock:
+            now = time()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
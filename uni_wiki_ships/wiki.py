@@ -1,104 +1,591 @@
+from StringIO import StringIO
 from common import AppException
 from cookielib import CookieJar
 from hashlib import md5
-from time import sleep
-from urllib import quote
-import datetime
+from multiprocessing.pool import ThreadPool
+from ratelimit import TokenBucket
+from time import sleep, time
+import Queue
+import collections
+import heapq
+import httplib
 import json
 import logging
+import metrics
+import profiling
+import random
+import socket
+import sys
+import threading
 import urllib
 import urllib2
+import urlparse
+import zlib
 logger = logging.getLogger(__name__)
 
+USER_AGENT = 'E-Uni Wiki Bot'
+"""User-Agent sent with every request to the wiki and for the static dump"""
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+"""Format of timestamps used by the wiki API, always in UTC"""
+
+BATCH_SIZE = 50
+"""Number of pages fetched in each request"""
+
+HIGH_BATCH_SIZE = 500
+"""Number of pages fetched in each request by users with apihighlimits"""
+
+MAX_URL_LENGTH = 2000
+"""Longest url sent as a GET, longer requests are sent as a POST"""
+
+MAXLAG = 5
+"""Seconds of database lag at which the wiki should refuse requests"""
+
+MAXLAG_RETRIES = 5
+"""Times to retry a request refused because of lag"""
+
+RETRIES = 3
+"""Times to retry fetching a single page before giving up on it"""
+
+BACKOFF = 1
+"""Seconds to wait before the first retry, doubled for each later one"""
+
+MAX_BACKOFF = 60
+"""Longest wait before retrying"""
+
+MAX_FAILURES = 10
+"""Failed requests in a row after which the wiki is taken to be down and the
+remaining pages are given up on"""
+
+Revision = collections.namedtuple('Revision', ['revid', 'timestamp', 'md5'])
+"""A revision of a page which has been fetched"""
+
 class RequestError(AppException): pass
 
+class UnexpectedResponse(RequestError):
+    """The wiki answered but not as expected for a title in the request"""
+
+TITLE_ERRORS = (UnexpectedResponse,)
+"""Errors a title in a batch can cause, as opposed to network, server or API
+errors"""
+
+def content_md5(content):
+    """md5 of page content as the wiki calculates it"""
+    return md5(content.encode('utf-8')).hexdigest()
+
+class Session(object):
+    """Keep-alive HTTP client with gzip and its own cookies
+    
+    Connections are pooled per host and reused by later requests, including
+    from other threads. Errors are raised as urllib2 exceptions.
+    
+    """
+    MAX_REDIRECTS = 5
+    
+    def __init__(self, timeout=60):
+        self.cookies = CookieJar()
+        self.timeout = timeout
+        self._pool = {}
+        self._lock = threading.Lock()
+    
+    def request(self, url, data=None):
+        """Make a request, a POST if data is given
+        
+        Args:
+            url (str): absolute url
+            data (str): urlencoded body
+        Returns:
+            (httplib.HTTPMessage): the headers of the response
+            (str): the decompressed body of the response
+        Throws:
+            urllib2.HTTPError: the server responded with an error
+            urllib2.URLError: the server could not be reached
+            
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response, body = self._send(url, data)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                if response.status != 307:
+                    data = None
+                continue
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, StringIO(body))
+            return response.msg, body
+        raise urllib2.URLError('Too many redirects for ' + url)
+    
+    def close(self):
+        """Close all pooled connections"""
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for connections in pool.values():
+            for connection in connections:
+                connection.close()
+    
+    def _send(self, url, data):
+        """Send one request, retrying once if a reused connection was stale"""
+        request = urllib2.Request(url, data, {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip',
+        })
+        if data is not None:
+            request.add_header('Content-Type', 'application/x-www-form-urlencoded')
+        self.cookies.add_cookie_header(request)
+        headers = dict(request.header_items())
+        key = (request.get_type(), request.get_host())
+        selector = request.get_selector()
+        for attempt in (1, 2):
+            connection, reused = self._connection(key)
+            try:
+                connection.request(request.get_method(), selector, data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and attempt == 1:
+                    continue
+                raise urllib2.URLError(e)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._pool.setdefault(key, []).append(connection)
+        self.cookies.extract_cookies(_Response(response.msg), request)
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return response, body
+    
+    def _connection(self, key):
+        """A pooled connection to key, or a new one
+        
+        Returns:
+            (httplib.HTTPConnection): the connection
+            (bool): whether it has been used before
+            
+        """
+        with self._lock:
+            try:
+                return self._pool[key].pop(), True
+            except (KeyError, IndexError):
+                pass
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+class _Response(object):
+    """The parts of a urllib2 response CookieJar needs"""
+    def __init__(self, headers):
+        self._headers = headers
+    
+    def info(self):
+        return self._headers
+
 class Wiki(object):
-    def __init__(self, url, delay):
+    def __init__(self, url, rate=1, concurrency=1, burst=1, store=None):
+        """Create a wiki client
+        
+        Args:
+            url (str): base url of the wiki
+            rate (float): maximum requests per second, 0 for no limit
+            concurrency (int): maximum requests in flight at once
+            burst (int): requests that may be made at once before rate applies
+            store (PageStore): local copy of pages, only changed pages are
+                                fetched when given
+        
+        """
         self._url = url
-        self.delay = delay
+        self.store = store
+        self.limiter = TokenBucket(rate, burst)
+        self.concurrency = max(concurrency, 1)
+        self.session = Session()
+        self.batch_size = BATCH_SIZE
+        self.maxlag = MAXLAG
+        self.failed = []
+        self.fetched = {}
+        self._edit_token = None
+        self._edit_token_lock = threading.Lock()
         self.logged_in = False
+        self.profiler = profiling.Profiler(enabled=False)
     
     def _build_url(self, action, **params):
-        return '{}/w/api.php?action={}&{}'.format(
-                self._url, action,
-                '&'.join('{}={}'.format(k, v) for k, v in params.iteritems()))
+        return '{}/w/api.php?{}'.format(self._url, _encode(action=action, **params))
         
     def _make_request(self, action, post=False, **kwargs):
-        if post:
-            kwargs['format'] = 'json'
-            request = urllib2.Request(self._build_url(action), urllib.urlencode(kwargs.items()))
-        else:
-            request = urllib2.Request(self._build_url(action, format='json', **kwargs))
-        logger.debug('Fetching from wiki: '+request.get_full_url())
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            logger.warning('Error code %s for page %s response was %s',
-                      e.code, request.get_full_url(), e.read())
-            raise
-        return json.load(response)
+        """Make an API request, waiting and retrying while the wiki is lagged
+        
+        Requests are sent as a POST if post is set or the url would be longer
+        than MAX_URL_LENGTH.
+        
+        Returns:
+            (dict): the decoded response
+        
+        """
+        kwargs['format'] = 'json'
+        if self.maxlag:
+            kwargs['maxlag'] = self.maxlag
+        url = self._build_url(action, **kwargs)
+        data = None
+        if post or len(url) > MAX_URL_LENGTH:
+            url, data = self._build_url(action), _encode(**kwargs)
+        for attempt in range(MAXLAG_RETRIES + 1):
+            self.limiter.acquire()
+            logger.debug('Fetching from wiki: '+url)
+            start = time()
+            try:
+                headers, body = self.session.request(url, data)
+            except urllib2.HTTPError as e:
+                _record(action, start, e.code)
+                logger.warning('Error code %s for page %s response was %s',
+                          e.code, url, e.read())
+                raise
+            except urllib2.URLError:
+                _record(action, start, 'error')
+                raise
+            self.profiler.add('requests')
+            self.profiler.add('bytes', int(headers.getheader('Content-Length') or len(body)))
+            response = json.loads(body)
+            error = response.get('error', {})
+            _record(action, start, error.get('code', 'ok'))
+            if error.get('code') != 'maxlag':
+                return response
+            wait = int(headers.getheader('Retry-After') or self.maxlag) * 2 ** attempt
+            logger.warning('Wiki is lagged (%s), waiting %s seconds',
+                           error.get('info'), wait)
+            sleep(wait)
+        raise RequestError('Wiki is lagged: {}'.format(error.get('info')))
+    
+    def _retry_request(self, action, **kwargs):
+        """Make an API request, retrying network and server errors with backoff
+        
+        Returns:
+            (dict): the decoded response
+        Throws:
+            RequestError: the request still failed after RETRIES retries
+        
+        """
+        for attempt in range(RETRIES + 1):
+            try:
+                return self._make_request(action, **kwargs)
+            except (urllib2.URLError, ValueError) as e:
+                if attempt == RETRIES:
+                    raise RequestError('Could not reach the wiki: {}'.format(e))
+                delay = _backoff(attempt)
+                logger.warning('Retrying %s in %.1f seconds after: %s', action, delay, e)
+                sleep(delay)
     
     def login(self, username, password, token=''):
-        urllib2.install_opener(urllib2.build_opener(urllib2.HTTPCookieProcessor(CookieJar())))
-        response = self._make_request('login', post=True, lgname=username, lgpassword=password)
+        response = self._retry_request('login', post=True, lgname=username, lgpassword=password)
         if response['login']['result'] == 'NeedToken':
-            response = self._make_request('login', post=True, lgname=username, lgpassword=password,
-                                          lgtoken=response['login']['token'])
+            response = self._retry_request('login', post=True, lgname=username, lgpassword=password,
+                                           lgtoken=response['login']['token'])
         result = response['login']['result']
         if not result == 'Success':
             raise RequestError('Invalid login: {}'.format(result))
-        self._edit_token = False
+        self._edit_token = None
         self.logged_in = True
+        self._detect_limits()
+    
+    def _detect_limits(self):
+        """Use bigger batches if the user has apihighlimits"""
+        response = self._retry_request('query', meta='userinfo', uiprop='rights')
+        if 'apihighlimits' in response['query']['userinfo'].get('rights', []):
+            logger.info('User has apihighlimits, fetching %s pages at once',
+                        HIGH_BATCH_SIZE)
+            self.batch_size = HIGH_BATCH_SIZE
+        else:
+            self.batch_size = BATCH_SIZE
     
     def get_pages(self, pages):
         """Get pages from wiki in raw wikitext format
     
         Args:
             pages (list): pages to get
-            pause (int): seconds to pause between queries to wiki
         Returns:
             (dict): format of {page: content}
+            (list): pages which do not exist
         
         """
-        #next_run in past so first run never delayed
-        next_run = datetime.datetime.now() - datetime.timedelta(hours=1)
         output = {}
         missing = []
-        pages_to_fetch = len(pages) / 50 + 1
-        for i in range(0, len(pages), 50):
-            while datetime.datetime.now() < next_run:
-                sleep(1)
-            print('Fetching page {} of {}'.format(i / 50 + 1, pages_to_fetch))
-            try:
-                response = self._make_request('query', prop='revisions',
-                                rvprop='content',
-                                titles='|'.join([quote(i) for i in pages[i:i+50]]))
-            except urllib2.HTTPError:
-                pass
-            else:
-                for page in response['query']['pages'].values():
-                    try:
-                        content = page['revisions'][0]['*']
-                    except KeyError:
-                        if 'missing' in page:
-                            logger.info('No page %s', page['title'])
-                            missing.append(page['title'])
-                        else:
-                            raise
-                    else:
-                        output[page['title']] = content
-            next_run = datetime.datetime.now() + datetime.timedelta(seconds=self.delay)
+        for contents, not_found in self.iter_pages(pages):
+            output.update(contents)
+            missing.extend(not_found)
         return output, missing
     
-    def edit_page(self, page, new_content):
+    def iter_pages(self, pages):
+        """Get pages from wiki in raw wikitext format, a batch at a time
+        
+        Batches of pages are fetched concurrently, up to concurrency at a time,
+        with the requests limited by the rate limiter. If there is a page store
+        the latest revision of every page is checked first and only the content
+        of pages which have changed since they were stored is fetched. Pages
+        which could not be fetched, even after retrying, are left in failed.
+        The revision of each page returned is kept in fetched.
+    
+        Args:
+            pages (list): pages to get
+        Returns:
+            (iterator): of ({page: content}, [missing pages]) for each batch
+        
+        """
+        self.failed = []
+        to_fetch = pages
+        if self.store is not None:
+            to_fetch = []
+            for found, not_found in self._query_pages(pages, 'lastrevid', prop='info'):
+                output = {}
+                for page in found:
+                    stored = self.store.get(page['title'])
+                    if stored and stored.revid == page['lastrevid']:
+                        output[page['title']] = stored.content
+                        self.fetched[page['title']] = Revision(stored.revid,
+                                stored.timestamp, content_md5(stored.content))
+                    else:
+                        to_fetch.append(page['title'])
+                metrics.PAGES.inc(len(output), result='stored')
+                metrics.PAGES.inc(len(not_found), result='missing')
+                yield output, not_found
+            logger.info('%s of %s pages have changed', len(to_fetch), len(pages))
+        for found, not_found in self._query_pages(to_fetch, 'revisions',
+                                                  prop='revisions',
+                                                  rvprop='content|ids|timestamp'):
+            output = {}
+            for page in found:
+                revision = page['revisions'][0]
+                output[page['title']] = revision['*']
+                self.fetched[page['title']] = Revision(revision['revid'],
+                        revision['timestamp'], content_md5(revision['*']))
+                if self.store is not None:
+                    self.store.put(page['title'], revision['revid'],
+                                   revision['timestamp'], revision['*'])
+            if self.store is not None:
+                self.store.commit()
+            metrics.PAGES.inc(len(output), result='fetched')
+            metrics.PAGES.inc(len(not_found), result='missing')
+            yield output, not_found
+        metrics.PAGES.inc(len(self.failed), result='failed')
+        if self.failed:
+            logger.warning('Could not fetch %s pages: %s', len(self.failed),
+                           ', '.join(self.failed))
+    
+    def recent_changes(self, since, namespace=0):
+        """Titles of pages edited or created since a time
+        
+        Args:
+            since (str): timestamp in the wiki's format, as TIMESTAMP_FORMAT
+            namespace (int): namespace to look for changes in
+        Returns:
+            (set): titles of the changed pages
+        
+        """
+        titles = set()
+        params = {'list': 'recentchanges', 'rcstart': since, 'rcdir': 'newer',
+                  'rcnamespace': namespace, 'rctype': 'edit|new',
+                  'rcprop': 'title', 'rclimit': 500}
+        while True:
+            response = self._retry_request('query', **params)
+            titles.update(i['title'] for i in response['query']['recentchanges'])
+            more = (response.get('query-continue', {}).get('recentchanges')
+                    or response.get('continue'))
+            if not more:
+                return titles
+            params.update(more)
+    
+    def _query_pages(self, titles, required, **params):
+        """Query the wiki for titles in concurrent batches
+        
+        A batch which fails because of a title in it is split in half to
+        isolate the bad title. A batch which fails because of the network, the
+        server or an API error is retried whole after an exponential backoff
+        with jitter, and no batch is started until the backoff is over. Titles
+        which still fail after RETRIES retries are added to failed, as is
+        everything left once MAX_FAILURES requests in a row have failed.
+        
+        Args:
+            titles (list): pages to query
+            required (str): key every page in the result must have
+            params: parameters for the query
+        Returns:
+            (iterator): of (pages, missing) for each batch, where pages is a
+                        list of the page results and missing a list of titles
+        
+        """
+        #heap of (time to start, attempts so far, batch)
+        scheduled = [(0, 0, titles[i:i+self.batch_size])
+                     for i in range(0, len(titles), self.batch_size)]
+        if not scheduled:
+            return
+        results = Queue.Queue()
+        running = done = failures = 0
+        paused_until = 0
+        pool = ThreadPool(min(self.concurrency, len(scheduled)))
+        try:
+            while scheduled or running:
+                now = time()
+                while scheduled and scheduled[0][0] <= now and paused_until <= now:
+                    _, attempts, batch = heapq.heappop(scheduled)
+                    pool.apply_async(self._run_batch,
+                                     (batch, attempts, params, required, results))
+                    running += 1
+                try:
+                    batch, attempts, result = results.get(timeout=max(
+                            max(scheduled[0][0], paused_until) - now, 0)
+                            if scheduled else 60)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                title_error = isinstance(result, TITLE_ERRORS)
+                if not isinstance(result, Exception):
+                    failures = 0
+                    done += len(batch)
+                    #progress goes to stderr, stdout may be carrying the report
+                    sys.stderr.write('Fetched {} of {} pages\n'.format(done, len(titles)))
+                    yield result
+                    continue
+                if not title_error:
+                    failures += 1
+                if failures >= MAX_FAILURES:
+                    given_up = [batch] + [i[2] for i in scheduled]
+                    scheduled = []
+                    logger.error('Giving up on %s pages after %s failed requests '
+                                 'in a row: %s', sum(len(i) for i in given_up),
+                                 failures, result)
+                    for i in given_up:
+                        self.failed.extend(i)
+                        done += len(i)
+                elif title_error and len(batch) > 1:
+                    logger.info('Splitting batch of %s pages after: %s',
+                                len(batch), result)
+                    half = len(batch) // 2
+                    heapq.heappush(scheduled, (0, 0, batch[:half]))
+                    heapq.heappush(scheduled, (0, 0, batch[half:]))
+                elif attempts < RETRIES:
+                    delay = _backoff(attempts)
+                    logger.info('Retrying %s pages in %.1f seconds after: %s',
+                                len(batch), delay, result)
+                    if not title_error:
+                        #the wiki is struggling, give it a rest from every batch
+                        paused_until = max(paused_until, time() + delay)
+                    heapq.heappush(scheduled, (time() + delay, attempts + 1, batch))
+                else:
+                    logger.warning('Giving up on %s pages after: %s', len(batch), result)
+                    self.failed.extend(batch)
+                    done += len(batch)
+        finally:
+            pool.terminate()
+    
+    def _run_batch(self, batch, attempts, params, required, results):
+        """Query a batch in a worker thread and put the result or error in results"""
+        try:
+            result = self._query_batch(batch, params, required)
+        except (urllib2.URLError, RequestError, ValueError, KeyError) as e:
+            result = e
+        except Exception as e:
+            logger.exception('Unexpected error fetching %s', ', '.join(batch))
+            result = e
+        results.put((batch, attempts, result))
+    
+    def _query_batch(self, batch, params, required):
+        """Query one batch of pages for _query_pages
+        
+        If the wiki truncates the response it is continued and the parts of
+        each page merged.
+        
+        Throws:
+            UnexpectedResponse: a page in the response is missing the required key
+            RequestError: the wiki is lagged or answered with an error, or
+                            without any pages
+            urllib2.URLError: the request failed
+        
+        """
+        pages = {}
+        params = dict(params, titles='|'.join(batch))
+        with self.profiler.stage('fetch_batch', cpu=False, pages=len(batch)):
+            while True:
+                response = self._make_request('query', **params)
+                #errors such as ratelimited come with a 200, and are not the
+                #fault of any one title
+                if 'error' in response:
+                    raise RequestError('Wiki error {}: {}'.format(
+                            response['error'].get('code'),
+                            response['error'].get('info')))
+                if 'pages' not in response.get('query', {}):
+                    raise RequestError('No pages in response: {}'.format(response))
+                for key, page in response['query']['pages'].iteritems():
+                    merged = pages.setdefault(key, page)
+                    for name, value in page.iteritems():
+                        merged.setdefault(name, value)
+                more = (response.get('query-continue', {}).get(params['prop'])
+                        or response.get('continue'))
+                if not more:
+                    break
+                params.update(more)
+        found = []
+        missing = []
+        for page in pages.values():
+            if 'missing' in page:
+                logger.info('No page %s', page['title'])
+                missing.append(page['title'])
+            elif required not in page:
+                raise UnexpectedResponse('Unexpected response for {}: {}'\
+                                   .format(page.get('title'), page))
+            else:
+                found.append(page)
+        return found, missing
+    
+    def edit_token(self):
+        """The token needed to edit, fetched on first use"""
+        with self._edit_token_lock:
+            if not self._edit_token:
+                response = self._retry_request('query', prop='info|revisions',
+                                                       intoken='edit',
+                                                       titles='Main Page')
+                self._edit_token = response['query']['pages'].values()[0]['edittoken']
+            return self._edit_token
+    
+    def edit_page(self, page, new_content, basetimestamp=None):
+        """Replace the content of a page
+        
+        Args:
+            page (str): title of the page
+            new_content (unicode): the new content
+            basetimestamp (str): timestamp of the revision the edit is based on,
+                                    the edit fails if the page has changed since
+        Throws:
+            RequestError: the edit failed
+        
+        """
         new_content = new_content.encode('utf-8')
-        if not self._edit_token:
-            response = self._make_request('query', prop='info|revisions',
-                                                  intoken='edit',
-                                                  titles='Main%20Page')
-            self._edit_token = response['query']['pages'].values()[0]['edittoken']
-        response = self._make_request('edit', post=True, title=page, text=new_content,
-                           token=self._edit_token, bot='', md5=md5(new_content).hexdigest())
+        params = {}
+        if basetimestamp:
+            params['basetimestamp'] = basetimestamp
+        token = self.edit_token()
+        with self.profiler.stage('edit', cpu=False):
+            response = self._make_request('edit', post=True, title=page,
+                               text=new_content, token=token, bot='',
+                               md5=md5(new_content).hexdigest(), **params)
+        if 'error' in response:
+            raise RequestError(response['error'].get('info') or response['error']['code'])
+        if 'edit' not in response:
+            raise RequestError('Unexpected response to edit: {}'.format(response))
         if response['edit']['result'] != 'Success':
             raise RequestError(response['edit']['result'])
-        
\ No newline at end of file
+
+def _backoff(attempts):
+    """Seconds to wait before retrying after attempts, with jitter"""
+    delay = min(BACKOFF * 2 ** attempts, MAX_BACKOFF)
+    return random.uniform(delay / 2.0, delay)
+
+def _record(action, start, result):
+    """Count a request made at start in the metrics"""
+    metrics.REQUESTS.inc(action=action, result=result)
+    metrics.REQUEST_SECONDS.observe(time() - start, action=action)
+
+def _encode(**params):
+    """Url encode parameters, with unicode values as UTF-8"""
+    return urllib.urlencode([(k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                             for k, v in params.iteritems()])